@@ -0,0 +1,41 @@
+SELECT
+    fw.id,
+    fw.title,
+    fw.description,
+    fw.rating,
+    fw.type,
+    fw.created,
+    fw.modified as modified,
+    (EXTRACT(EPOCH FROM GREATEST(
+        fw.modified,
+        MAX(p.modified),
+        MAX(g.modified),
+        MAX(pfw.created),
+        MAX(gfw.created)
+    )) * 1000000)::bigint as version,
+    COALESCE (
+       json_agg(
+           DISTINCT jsonb_build_object(
+               'person_role', pfw.role,
+               'person_id', p.id,
+               'person_name', p.full_name
+           )
+       ) FILTER (WHERE p.id is not null),
+       '[]'
+    ) as persons,
+    COALESCE (
+       json_agg(
+           DISTINCT jsonb_build_object(
+               'genre_name', g.name,
+               'genre_id', g.id
+           )
+       ) FILTER (WHERE g.id is not null),
+       '[]'
+    ) as genres
+FROM content.film_work fw
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+WHERE {where}
+GROUP BY fw.id
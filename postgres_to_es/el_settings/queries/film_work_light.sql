@@ -0,0 +1,33 @@
+SELECT
+    fw.id,
+    fw.title,
+    fw.description,
+    fw.rating,
+    fw.type,
+    fw.created,
+    fw.modified as modified,
+    (EXTRACT(EPOCH FROM GREATEST(
+        fw.modified,
+        (
+            SELECT MAX(pfw.created)
+            FROM content.person_film_work pfw
+            WHERE pfw.film_work_id = fw.id
+        ),
+        (
+            SELECT MAX(gfw.created)
+            FROM content.genre_film_work gfw
+            WHERE gfw.film_work_id = fw.id
+        )
+    )) * 1000000)::bigint as version,
+    ARRAY(
+        SELECT ARRAY[pfw.person_id::text, pfw.role::text]
+        FROM content.person_film_work pfw
+        WHERE pfw.film_work_id = fw.id
+    ) as person_roles,
+    ARRAY(
+        SELECT gfw.genre_id::text
+        FROM content.genre_film_work gfw
+        WHERE gfw.film_work_id = fw.id
+    ) as genre_ids
+FROM content.film_work fw
+WHERE {where}
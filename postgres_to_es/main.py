@@ -1,46 +1,375 @@
+import argparse
 import logging
-from time import sleep
+import os
+import random
+from collections import defaultdict
+from contextlib import ExitStack, nullcontext
+from queue import Queue
+from threading import Thread
+from time import perf_counter, sleep
+
+from more_itertools import chunked
 
 from postgres_to_es.tools.config import (
     LOGGING,
+    PROFILE_DIR,
     STORAGE,
+    CoordinationConfig,
     ESConfig,
+    GovernorConfig,
     MainConfig,
+    Partition,
+    PipelineConfig,
     PostgresConfig,
+    ProfileConfig,
+    SinkConfig,
+    load_pipelines,
+)
+from postgres_to_es.tools.coordination import (
+    Lease,
+    LeaseLost,
+    LeaseManager,
+    PostgresClient,
+    PostgresStorage,
 )
 from postgres_to_es.tools.extractor import PostgresExtractor
 from postgres_to_es.tools.loader import Loader
+from postgres_to_es.tools.ndjson import (
+    REPLAY_STORAGE,
+    NDJSONSink,
+    NDJSONSource,
+)
+from postgres_to_es.tools.profiler import CycleProfiler
+from postgres_to_es.tools.reconcile import Reconciler
 from postgres_to_es.tools.state import JsonFileStorage, State
+from postgres_to_es.tools.sync_cycle import SyncCycle
 
 main_config = MainConfig()
 es_config = ESConfig()
 pg_config = PostgresConfig()
+profile_config = ProfileConfig()
+sink_config = SinkConfig()
+coord_config = CoordinationConfig()
+governor_config = GovernorConfig()
 
 chunk_size = main_config.chunk_size
 delay = main_config.delay
+copy_initial = main_config.copy_initial
+compact_rows = main_config.compact_rows
+dimension_cache = main_config.dimension_cache
+person_cache_size = main_config.person_cache_size
+priority_latency = main_config.priority_latency
+sync_cycle = main_config.sync_cycle
+pipelines = load_pipelines(main_config.pipelines)
 state = State(JsonFileStorage(STORAGE))
+profiler = CycleProfiler(profile_config, PROFILE_DIR)
+log = logging.getLogger(__name__)
 
 
-def etl(load: Loader, extract: PostgresExtractor) -> None:
+def etl(
+    load: Loader, extract: PostgresExtractor, lease: Lease = None
+) -> None:
     """
     Функция ETL (Extract, transform, load)
     :param load: Принимает объект Loader
     :param extract: Принимает объект PostgresExtractor
+    :param lease: аренда части работы, проверяется перед каждой пачкой
+    Документы, версия которых в индексе оказалась выше
+    (версия уменьшилась после удаления связи), в конце цикла
+    перечитываются и записываются поверх версии индекса.
     """
     postgres_extract = extract.extractors()
-    for items, index in postgres_extract:
-        # print(items)
-        # print(index)
-        load.bulk(index, items)
+    lowered: list[str] = []
+    for index, items, seq in postgres_extract:
+        if lease is not None:
+            lease.check()
+        started = perf_counter()
+        lowered += load.bulk(items, index)
+        extract.phases["load"] += perf_counter() - started
+        extract.checkpoints.ack(seq)
+    for ids in chunked(lowered, extract.batch_size):
+        if lease is not None:
+            lease.check()
+        load.overwrite(extract.documents_in(ids), extract.pipeline.index)
+
+
+def run_pipeline(
+    pipeline: PipelineConfig,
+    errors: Queue,
+    pipeline_state: State,
+    sink: NDJSONSink = None,
+    cycle: SyncCycle = None,
+) -> None:
+    """
+    Бесконечный цикл ETL одного пайплайна
+    со своими подключениями, размером пачки и задержкой.
+    В общем цикле пайплайн после каждого цикла ждет остальные,
+    задержка общая - MAIN_DELAY.
+    :param pipeline: описание пайплайна
+    :param errors: очередь для передачи ошибки в основной поток
+    :param pipeline_state: состояния пайплайна
+    :param sink: запись пачек в NDJSON сегменты вместо Elasticsearch
+    :param cycle: общий цикл пайплайнов
+    """
+    pipeline_delay = delay if cycle else pipeline.delay or delay
+    try:
+        with (
+            nullcontext(sink) if sink else Loader(es_config, [pipeline])
+        ) as loader:
+            with PostgresExtractor(
+                    pg_config,
+                    pipeline,
+                    chunk_size,
+                    pipeline_state,
+                    copy_initial=copy_initial,
+                    compact_rows=compact_rows,
+                    dimension_cache=dimension_cache,
+                    person_cache_size=person_cache_size,
+                    priority_latency=priority_latency,
+                    cycle=cycle,
+                    governor=governor_config,
+            ) as extractor:
+                number = 0
+                while True:
+                    number += 1
+                    with profiler.profile(
+                            pipeline.name, number, extractor.phases
+                    ):
+                        etl(loader, extractor)
+                    if cycle is not None:
+                        cycle.wait()
+                    log.info(f"{pipeline.name} sleep {pipeline_delay} sek")
+                    sleep(pipeline_delay)
+    except Exception as error:
+        if cycle is not None:
+            cycle.abort()
+        errors.put((pipeline.name, error))
+
+
+def run_pipelines(pipeline_state: State, sink: NDJSONSink = None) -> None:
+    """
+    Запускает все пайплайны в отдельных потоках
+    и завершает работу при остановке любого из них.
+    При MAIN_SYNC_CYCLE пайплайны работают в общем цикле.
+    :param pipeline_state: состояния пайплайнов
+    :param sink: запись пачек в NDJSON сегменты вместо Elasticsearch
+    """
+    pipeline_errors: Queue = Queue()
+    cycle = SyncCycle(pipeline_state, len(pipelines)) if sync_cycle else None
+    for item in pipelines:
+        Thread(
+            target=run_pipeline,
+            args=(item, pipeline_errors, pipeline_state, sink, cycle),
+            name=item.name,
+            daemon=True,
+        ).start()
+    name, pipeline_error = pipeline_errors.get()
+    log.error(f"Pipeline {name} stopped: {pipeline_error}")
+    raise pipeline_error
+
+
+def run_worker(number: int, errors: Queue) -> None:
+    """
+    Бесконечный цикл обработчика частей работы.
+    Части (пайплайн и диапазон uuid) берутся в аренду через Postgres,
+    за один захват выполняется один цикл ETL части.
+    Состояния частей хранятся в общей таблице Postgres.
+    Loader и PostgresExtractor создаются один раз на пайплайн,
+    при захвате части extractor переключается на ее стейт и диапазон.
+    :param number: номер обработчика в экземпляре
+    :param errors: очередь для передачи ошибки в основной поток
+    """
+    owner = f"{coord_config.owner}-{number}"
+    units = [
+        (pipeline, partition)
+        for pipeline in pipelines
+        for partition in Partition.split(coord_config.partitions)
+    ]
+    cycles: dict[str, int] = defaultdict(int)
+    try:
+        with PostgresClient(pg_config) as client, ExitStack() as stack:
+            leases = LeaseManager(client, owner, coord_config.lease_ttl)
+            workers: dict[str, tuple[Loader, PostgresExtractor]] = {}
+            while True:
+                claimed = False
+                for pipeline, partition in random.sample(units, len(units)):
+                    unit = f"{pipeline.name}{partition.suffix}"
+                    lease = leases.acquire(unit, pipeline.delay or delay)
+                    if lease is None:
+                        continue
+                    claimed = True
+                    unit_state = State(
+                        PostgresStorage(client, fence=(unit, owner))
+                    )
+                    if pipeline.name not in workers:
+                        workers[pipeline.name] = (
+                            stack.enter_context(
+                                Loader(es_config, [pipeline])
+                            ),
+                            stack.enter_context(PostgresExtractor(
+                                pg_config,
+                                pipeline,
+                                chunk_size,
+                                unit_state,
+                                copy_initial=copy_initial,
+                                compact_rows=compact_rows,
+                                partition=partition,
+                                dimension_cache=dimension_cache,
+                                person_cache_size=person_cache_size,
+                                priority_latency=priority_latency,
+                                governor=governor_config,
+                            )),
+                        )
+                    loader, extractor = workers[pipeline.name]
+                    extractor.bind(unit_state, partition)
+                    cycles[unit] += 1
+                    try:
+                        with lease, profiler.profile(
+                                unit, cycles[unit], extractor.phases
+                        ):
+                            etl(loader, extractor, lease)
+                    except LeaseLost:
+                        log.info(f"{owner} stop {unit}: lease lost")
+                if not claimed:
+                    log.info(f"{owner} no free units, sleep {delay} sek")
+                    sleep(delay)
+    except Exception as error:
+        errors.put((owner, error))
+
+
+def seed_units() -> None:
+    """
+    Переносит дату последней проверки пайплайнов из локального стейта
+    в стейты частей, которых еще нет в Postgres.
+    Все документы, измененные до этой даты, уже загружены,
+    поэтому она верна для любого диапазона uuid,
+    и включение координации не запускает полную перезагрузку.
+    """
+    seeds = {}
+    for pipeline in pipelines:
+        last_modified = state.get_state(f"{pipeline.name}_last_modified")
+        if last_modified is None:
+            last_modified = state.get_state("last_modified")
+        if last_modified is None:
+            continue
+        for partition in Partition.split(coord_config.partitions):
+            seeds[
+                f"{pipeline.name}{partition.suffix}_last_modified"
+            ] = last_modified
+    if not seeds:
+        return
+    with PostgresClient(pg_config) as client:
+        PostgresStorage(client).seed_state(seeds)
+    log.info(f"Seed {len(seeds)} unit states from {STORAGE}")
+
+
+def run_workers() -> None:
+    """
+    Запускает обработчики частей работы в отдельных потоках
+    и завершает работу при остановке любого из них.
+    """
+    worker_errors: Queue = Queue()
+    for number in range(coord_config.workers):
+        Thread(
+            target=run_worker,
+            args=(number, worker_errors),
+            name=f"worker-{number}",
+            daemon=True,
+        ).start()
+    name, worker_error = worker_errors.get()
+    log.error(f"Worker {name} stopped: {worker_error}")
+    raise worker_error
+
+
+def replay(path: str, index_suffix: str) -> None:
+    """
+    Однократная загрузка NDJSON сегментов в Elasticsearch.
+    Индексы создаются с суффиксом index_suffix,
+    что позволяет загрузить выгрузку в новую версию индексов.
+    Номер загруженной пачки хранится в DIR/replay.json, а не в общем
+    стейте: файловое хранилище не защищено от записи другим процессом.
+    :param path: каталог сегментов
+    :param index_suffix: суффикс целевых индексов
+    """
+    targets = [
+        pipeline.copy(update={"index": pipeline.index + index_suffix})
+        for pipeline in pipelines
+    ]
+    replay_state = State(JsonFileStorage(os.path.join(path, REPLAY_STORAGE)))
+    source = NDJSONSource(path, replay_state, index_suffix=index_suffix)
+    with Loader(es_config, targets) as loader:
+        for index, items, seq in source.batches():
+            loader.bulk(items, index)
+            source.checkpoints.ack(seq)
+
+
+def reconcile() -> None:
+    """
+    Однократная сверка индексов всех пайплайнов с Postgres.
+    """
+    for pipeline in pipelines:
+        with Loader(es_config, [pipeline]) as loader:
+            with PostgresExtractor(
+                    pg_config,
+                    pipeline,
+                    chunk_size,
+                    state,
+                    compact_rows=compact_rows,
+                    governor=governor_config,
+            ) as extractor:
+                Reconciler(extractor, loader).run()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="профилировать циклы ETL (PROFILE_ENABLE)",
+    )
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="сверить индексы с Postgres и завершить работу",
+    )
+    parser.add_argument(
+        "--sink",
+        metavar="DIR",
+        help="писать пачки в NDJSON сегменты вместо Elasticsearch",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="DIR",
+        help="загрузить NDJSON сегменты в Elasticsearch и завершить работу",
+    )
+    parser.add_argument(
+        "--index-suffix",
+        default="",
+        help="суффикс индексов для --replay",
+    )
+    args = parser.parse_args()
+    if args.sink and coord_config.enabled:
+        parser.error("--sink нельзя использовать при COORD_ENABLE=true")
+    if args.profile:
+        profile_config.enabled = True
     logging.basicConfig(**LOGGING)
-    log = logging.getLogger(__name__)
+    if args.reconcile:
+        log.info("start reconcile")
+        reconcile()
+        raise SystemExit(0)
+    if args.replay:
+        log.info("start replay")
+        replay(args.replay, args.index_suffix)
+        raise SystemExit(0)
     log.info("start")
-    with Loader(es_config) as loader:
-        with PostgresExtractor(pg_config, chunk_size, state) as extractor:
-            while True:
-                etl(loader, extractor)
-                log.info(f"sleep {delay} sek")
-                sleep(delay)
+    if coord_config.enabled:
+        seed_units()
+        run_workers()
+    elif args.sink:
+        sink_state = State(
+            JsonFileStorage(os.path.join(args.sink, "storage.json"))
+        )
+        with NDJSONSink(args.sink, sink_config.segment_bytes) as ndjson_sink:
+            run_pipelines(sink_state, ndjson_sink)
+    else:
+        run_pipelines(state)
@@ -0,0 +1,118 @@
+import os
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_INTRANS
+
+from postgres_to_es.tools.state import BaseStorage, State
+
+# настройки, обязательные при импорте модулей tools
+for key, value in {
+    "DB_NAME": "movies",
+    "DB_USER": "app",
+    "DB_PASSWORD": "app",
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "ES_HOST": "http://localhost",
+    "ES_PORT": "9200",
+    "ES_BULK_MAX_RETYS": "1",
+    "ES_BULK_RETYS_SLEEP": "0",
+    "BO_START_SLEEP_TIME": "0.01",
+    "BO_FACTOR": "2",
+    "BO_BORDER_SLEEP_TIME": "1",
+    "MAIN_CHUNK": "2",
+    "MAIN_DELAY": "1",
+}.items():
+    os.environ.setdefault(key, value)
+
+
+class MemoryStorage(BaseStorage):
+    """Хранилище состояний в памяти, запоминает каждую запись."""
+
+    def __init__(self) -> None:
+        self.data: Dict[str, Any] = {}
+        self.writes: list[Dict[str, Any]] = []
+
+    def save_state(self, state: Dict[str, Any]) -> None:
+        self.writes.append(dict(state))
+        self.data.update(state)
+
+    def retrieve_state(self) -> Dict[str, Any]:
+        return dict(self.data)
+
+
+class FakeCursor:
+    """
+    Курсор, строки запроса которого возвращает обработчик подключения.
+    Настройки Governor (set_config, SET) пропускаются.
+    """
+
+    def __init__(self, connection: "FakeConnection"):
+        self.connection = connection
+        self.rows: list[Any] = []
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query: str, params: Any = None) -> None:
+        if "set_config" in query or query.startswith("SET "):
+            return
+        self.connection.queries.append((query, params))
+        self.rows = list(self.connection.handler(query, params))
+        self.rowcount = len(self.rows)
+
+    def fetchone(self) -> Optional[Any]:
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self) -> list[Any]:
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeConnection:
+    """
+    Подключение Postgres для тестов:
+    handler(query, params) возвращает строки запроса или бросает ошибку.
+    """
+
+    class info:
+        transaction_status = TRANSACTION_STATUS_INTRANS
+
+    def __init__(self, handler: Callable[[str, Any], Iterable[Any]]):
+        self.handler = handler
+        self.queries: list[tuple[str, Any]] = []
+        self.rollbacks = 0
+
+    def cursor(self, *args, **kwargs) -> FakeCursor:
+        return FakeCursor(self)
+
+    def rollback(self) -> None:
+        self.rollbacks += 1
+
+
+@pytest.fixture
+def memory_storage() -> Callable[[], MemoryStorage]:
+    """Фабрика хранилищ состояний в памяти."""
+    return MemoryStorage
+
+
+@pytest.fixture
+def storage(memory_storage) -> MemoryStorage:
+    return memory_storage()
+
+
+@pytest.fixture
+def state(storage: MemoryStorage) -> State:
+    return State(storage)
+
+
+@pytest.fixture
+def fake_connection() -> Callable[..., FakeConnection]:
+    """Фабрика подключений Postgres с обработчиком запросов."""
+    return FakeConnection
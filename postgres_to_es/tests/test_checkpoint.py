@@ -0,0 +1,232 @@
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+
+import pytest
+
+from postgres_to_es.tools.checkpoint import CheckpointTracker
+from postgres_to_es.tools.config import (
+    PIPELINES,
+    PostgresConfig,
+    load_pipelines,
+)
+from postgres_to_es.tools.extractor import PostgresExtractor
+from postgres_to_es.tools.state import State
+
+INDEX = "movies"
+# reference таблица person: uuid персоны -> фильмы через person_film_work
+PERSON_FILMS = {
+    "p1": ["f01", "f02", "f03"],
+    "p2": ["f03", "f04"],
+    "p3": ["f05"],
+    "p4": ["f06", "f07", "f08", "f09"],
+    "p5": ["f02", "f10"],
+}
+FILMS = {film for films in PERSON_FILMS.values() for film in films}
+
+
+class Crash(Exception):
+    """Падение процесса в заданной точке."""
+
+
+class CrashingTracker(CheckpointTracker):
+    """
+    CheckpointTracker, падающий после crash_at-й операции begin/ack.
+    Операция успевает выполниться, включая запись стейта.
+    """
+
+    def __init__(self, state: State, crash_at: Optional[int] = None):
+        super().__init__(state)
+        self.crash_at = crash_at
+        self.operations = 0
+
+    def begin(self, key: str, value: Any, parent: int = None) -> int:
+        seq = super().begin(key, value, parent)
+        self._tick()
+        return seq
+
+    def ack(self, seq: Optional[int]) -> None:
+        super().ack(seq)
+        self._tick()
+
+    def _tick(self) -> None:
+        self.operations += 1
+        if self.operations == self.crash_at:
+            raise Crash(self.operations)
+
+
+def person_films(query: str, params: list) -> list[dict[str, str]]:
+    """Запросы uuid reference таблицы и М2М по данным в памяти."""
+    params = list(params)
+    limit = params.pop()
+    if "DISTINCT" in query:
+        has_last = "film_work_id >" in query
+        last_uuid = params.pop() if has_last else None
+        ids = sorted({
+            film for person in params for film in PERSON_FILMS[person]
+        })
+    else:
+        has_last = "id >" in query
+        last_uuid = params.pop() if has_last else None
+        ids = sorted(PERSON_FILMS)
+    if last_uuid is not None:
+        ids = [i for i in ids if i > last_uuid]
+    return [{"id": i} for i in ids[:limit]]
+
+
+@pytest.fixture
+def make_extractor(
+    fake_connection,
+) -> Callable[[State, Optional[int]], PostgresExtractor]:
+    return lambda state, crash_at=None: _make_extractor(
+        state, fake_connection(person_films), crash_at
+    )
+
+
+def _make_extractor(
+    state: State, connection: Any, crash_at: Optional[int] = None
+) -> PostgresExtractor:
+    pipeline = load_pipelines(PIPELINES)[0]
+    extractor = PostgresExtractor(PostgresConfig(), pipeline, 2, state)
+    extractor.checkpoints = CrashingTracker(state, crash_at)
+    extractor.connection = connection
+    extractor.last_modified = datetime(1, 1, 1, tzinfo=timezone.utc)
+    extractor.start_time = datetime.now(timezone.utc)
+    extractor._extractor_documents_in = (
+        lambda index, in_ids, seq=None: iter([(index, list(in_ids), seq)])
+    )
+    return extractor
+
+
+def run_cascade(extractor: PostgresExtractor, loaded: list[str]) -> None:
+    """
+    Каскад изменений персон как в etl: пачка загружается,
+    затем подтверждается.
+    """
+    reference = extractor.pipeline.references[1]
+    for _, ids, seq in extractor._reference_extractor(reference, INDEX):
+        loaded.extend(ids)
+        extractor.checkpoints.ack(seq)
+
+
+def test_out_of_order_acks_hold_back_watermark(state, storage):
+    tracker = CheckpointTracker(state)
+    first = tracker.begin("film_work_last_uuid", "a")
+    second = tracker.begin("film_work_last_uuid", "b")
+    third = tracker.begin("film_work_last_uuid", "c")
+
+    tracker.ack(third)
+    tracker.ack(second)
+    assert state.get_state("film_work_last_uuid") is None
+    assert storage.writes == []
+
+    tracker.ack(first)
+    assert storage.writes == [{"film_work_last_uuid": "c"}]
+    assert tracker.pending() == 0
+
+
+def test_watermark_moves_through_contiguous_prefix(state, storage):
+    tracker = CheckpointTracker(state)
+    seqs = [tracker.begin("key", value) for value in "abcd"]
+
+    tracker.ack(seqs[0])
+    tracker.ack(seqs[2])
+    assert state.get_state("key") == "a"
+
+    tracker.ack(seqs[1])
+    assert state.get_state("key") == "c"
+    assert storage.writes == [{"key": "a"}, {"key": "c"}]
+
+
+def test_parent_completion_resets_child_in_same_write(state, storage):
+    tracker = CheckpointTracker(state)
+    parent = tracker.begin("person_last_uuid", "p2")
+    first = tracker.begin("m2m_last_uuid", "f02", parent=parent)
+    second = tracker.begin("m2m_last_uuid", "f04", parent=parent)
+
+    tracker.ack(parent)
+    assert storage.writes == []
+
+    tracker.ack(first)
+    assert storage.writes[-1] == {"m2m_last_uuid": "f02"}
+
+    tracker.ack(second)
+    assert storage.writes[-1] == {
+        "m2m_last_uuid": None,
+        "person_last_uuid": "p2",
+    }
+    assert tracker.pending() == 0
+
+
+def test_child_keeps_value_while_parent_open(state):
+    tracker = CheckpointTracker(state)
+    parent = tracker.begin("person_last_uuid", "p2")
+    child = tracker.begin("m2m_last_uuid", "f02", parent=parent)
+
+    tracker.ack(child)
+    assert state.get_state("m2m_last_uuid") == "f02"
+    assert state.get_state("person_last_uuid") is None
+
+
+def test_drain_callback_runs_after_last_ack(state):
+    tracker = CheckpointTracker(state)
+    seq = tracker.begin("key", "a")
+    drained = []
+    tracker.on_drain(lambda: drained.append(True))
+    assert drained == []
+
+    tracker.ack(seq)
+    assert drained == [True]
+
+
+def test_cascade_without_crash_loads_every_film(state, make_extractor):
+    loaded: list[str] = []
+    run_cascade(make_extractor(state), loaded)
+
+    assert set(loaded) == FILMS
+    assert state.get_state("person_film_work_movies_last_uuid") is None
+
+
+def test_resume_after_crash_skips_no_batch(memory_storage, make_extractor):
+    extractor = make_extractor(State(memory_storage()))
+    run_cascade(extractor, [])
+    operations = extractor.checkpoints.operations
+    assert operations > 0
+
+    for crash_at in range(1, operations + 1):
+        storage = memory_storage()
+        loaded: list[str] = []
+        with pytest.raises(Crash):
+            run_cascade(make_extractor(State(storage), crash_at), loaded)
+
+        persisted = dict(storage.data)
+        resumed: list[str] = []
+        run_cascade(make_extractor(State(storage)), resumed)
+
+        # после перезапуска догружается все, что не было
+        # гарантированно зафиксировано до падения
+        assert FILMS <= set(loaded) | set(resumed), crash_at
+        assert set(resumed) >= _films_after(persisted), crash_at
+        assert storage.data["person_film_work_movies_last_uuid"] is None
+
+
+def _films_after(persisted: dict[str, Any]) -> set[str]:
+    """
+    Фильмы, которые не покрыты сохраненными ключами:
+    все фильмы персон после person_last_uuid, кроме фильмов
+    первой незавершенной персоны до m2m_last_uuid.
+    """
+    last_person = persisted.get("person_movies_last_uuid")
+    last_film = persisted.get("person_film_work_movies_last_uuid")
+    persons = sorted(PERSON_FILMS)
+    batches = [persons[i:i + 2] for i in range(0, len(persons), 2)]
+    films: set[str] = set()
+    first = True
+    for batch in batches:
+        if last_person is not None and batch[-1] <= last_person:
+            continue
+        batch_films = {f for p in batch for f in PERSON_FILMS[p]}
+        if first and last_film is not None:
+            batch_films = {f for f in batch_films if f > last_film}
+        films |= batch_films
+        first = False
+    return films
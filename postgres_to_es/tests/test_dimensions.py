@@ -0,0 +1,101 @@
+from typing import Any
+
+import pytest
+
+from postgres_to_es.tools.dimensions import DimensionCache
+
+GENRES = {"g1": ("Drama", 10, 100)}
+PERSONS = {
+    "p1": ("Actor", 10, 100),
+    "p2": ("Writer", 20, 200),
+}
+
+
+class Dimensions:
+    """Запросы кешей справочников по данным в памяти."""
+
+    def __init__(self) -> None:
+        self.genres = dict(GENRES)
+        self.persons = dict(PERSONS)
+
+    def __call__(self, query: str, params: list = None) -> list[tuple]:
+        table = self.genres if "content.genre" in query else self.persons
+        if "max(modified)" in query:
+            return [(max(item[1] for item in table.values()),)]
+        if "id = ANY" in query:
+            return [
+                (key, table[key][0], table[key][2])
+                for key in params[0] if key in table
+            ]
+        watermark = params[0] if params else None
+        return [
+            (key, name, modified, version)
+            for key, (name, modified, version) in table.items()
+            if watermark is None or modified >= watermark
+        ]
+
+
+@pytest.fixture
+def dimensions() -> Dimensions:
+    return Dimensions()
+
+
+@pytest.fixture
+def connection(fake_connection, dimensions):
+    return fake_connection(dimensions)
+
+
+def film(
+    persons: list[tuple[str, str]], genres: list[str], version: int = 50
+) -> dict[str, Any]:
+    return {
+        "id": "f1",
+        "title": "Title",
+        "version": version,
+        "person_roles": [list(person) for person in persons],
+        "genre_ids": genres,
+    }
+
+
+def test_assemble_builds_full_row(connection):
+    cache = DimensionCache(10)
+    row = film([("p1", "actor"), ("p2", "writer"), ("p1", "actor")], ["g1"])
+
+    [result] = cache.assemble(connection, [row])
+
+    assert result["persons"] == [
+        {"person_role": "actor", "person_id": "p1", "person_name": "Actor"},
+        {"person_role": "writer", "person_id": "p2", "person_name": "Writer"},
+    ]
+    assert result["genres"] == [{"genre_name": "Drama", "genre_id": "g1"}]
+    assert result["version"] == 200
+    assert "person_roles" not in result and "genre_ids" not in result
+
+
+def test_late_genre_is_loaded_by_id(connection, dimensions):
+    cache = DimensionCache(10)
+    cache.assemble(connection, [film([], ["g1"])])
+    # жанр зафиксирован позже, но с modified раньше watermark
+    dimensions.genres["g2"] = ("Comedy", 5, 300)
+    connection.queries.clear()
+
+    for _ in range(2):
+        [result] = cache.assemble(connection, [film([], ["g1", "g2"])])
+        assert [g["genre_id"] for g in result["genres"]] == ["g1", "g2"]
+        assert result["version"] == 300
+    assert len(connection.queries) == 1
+    assert "id = ANY" in connection.queries[0][0]
+
+
+def test_stale_cache_picks_up_renamed_person(connection, dimensions):
+    cache = DimensionCache(10)
+    cache.assemble(connection, [film([("p1", "actor")], [])])
+    dimensions.persons["p1"] = ("Renamed", 30, 300)
+
+    [result] = cache.assemble(connection, [film([("p1", "actor")], [])])
+    assert result["persons"][0]["person_name"] == "Actor"
+
+    cache.stale = True
+    [result] = cache.assemble(connection, [film([("p1", "actor")], [])])
+    assert result["persons"][0]["person_name"] == "Renamed"
+    assert result["version"] == 300
@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from psycopg2 import OperationalError
+from psycopg2.errors import QueryCanceled
+
+from postgres_to_es.tools.config import (
+    PIPELINES,
+    GovernorConfig,
+    PostgresConfig,
+    load_pipelines,
+)
+from postgres_to_es.tools.extractor import PostgresExtractor
+from postgres_to_es.tools.governor import Governor
+
+CLOCK = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+# now() на подключении с незавершенной транзакцией - время ее начала
+FROZEN = CLOCK - timedelta(hours=1)
+LSN = "0/3000000"
+
+
+def server_time(query: str) -> datetime:
+    return CLOCK if "clock_timestamp()" in query else FROZEN
+
+
+def replica(in_recovery: bool, caught_up: bool, replayed: datetime):
+    return lambda query, params: [
+        (in_recovery, caught_up, replayed, server_time(query))
+    ]
+
+
+def primary(query: str, params):
+    return [(LSN, server_time(query))]
+
+
+@pytest.fixture
+def governor() -> Governor:
+    return Governor(GovernorConfig(max_replica_lag=30))
+
+
+def test_wal_position_uses_current_time(governor, fake_connection):
+    assert governor.wal_position(fake_connection(primary)) == (LSN, CLOCK)
+
+
+def test_caught_up_replica_has_no_lag(governor, fake_connection):
+    # primary простаивает: последняя примененная транзакция давно,
+    # но реплика применила журнал до текущей позиции primary
+    connection = fake_connection(
+        replica(True, True, CLOCK - timedelta(hours=2))
+    )
+    position = governor.wal_position(fake_connection(primary))
+
+    assert governor.replica_time(connection, position) == CLOCK
+    assert connection.queries[0][1] == [LSN]
+
+
+def test_lagging_replica_uses_replay_time(governor, fake_connection):
+    replayed = CLOCK - timedelta(seconds=10)
+    connection = fake_connection(replica(True, False, replayed))
+
+    assert governor.replica_time(connection, (LSN, CLOCK)) == replayed
+
+
+def test_replica_behind_max_lag_is_skipped(governor, fake_connection):
+    # с замороженным now() отставание было бы отрицательным
+    replayed = CLOCK - timedelta(seconds=60)
+    connection = fake_connection(replica(True, False, replayed))
+
+    assert governor.replica_time(connection, (LSN, CLOCK)) is None
+
+
+def test_canceled_query_shrinks_batch_and_gives_up(state, fake_connection):
+    limits = []
+
+    def cancel(query, params):
+        limits.append(params[-1])
+        raise QueryCanceled("canceling statement due to statement timeout")
+
+    pipeline = load_pipelines(PIPELINES)[0]
+    extractor = PostgresExtractor(
+        PostgresConfig(),
+        pipeline,
+        8,
+        state,
+        governor=GovernorConfig(cancel_retries=3),
+    )
+    extractor.connection = fake_connection(cancel)
+    extractor.last_modified = datetime(1, 1, 1, tzinfo=timezone.utc)
+    extractor.start_time = CLOCK
+
+    with pytest.raises(QueryCanceled):
+        list(extractor.extractor_documents(
+            table=pipeline.table, index=pipeline.index
+        ))
+
+    assert limits == [8, 4, 2, 1]
+    assert extractor.connection.rollbacks == 3
+
+
+def test_replica_failure_falls_back_to_primary(
+    state, fake_connection, monkeypatch
+):
+    def fail(query, params):
+        raise OperationalError("server closed the connection")
+
+    pipeline = load_pipelines(PIPELINES)[0]
+    extractor = PostgresExtractor(
+        PostgresConfig(),
+        pipeline,
+        8,
+        state,
+        governor=GovernorConfig(replica_host="replica"),
+    )
+    opened = []
+
+    def open_connection():
+        opened.append(extractor.dsl["host"])
+        extractor.connection = fake_connection(lambda query, params: [])
+
+    monkeypatch.setattr(extractor, "_open", open_connection)
+    monkeypatch.setattr(extractor, "_close", lambda: None)
+    extractor.dsl = extractor.replica_dsl
+    extractor.connection = fake_connection(fail)
+    extractor.last_modified = datetime(1, 1, 1, tzinfo=timezone.utc)
+    extractor.start_time = CLOCK
+
+    assert list(extractor.extractor_documents(
+        table=pipeline.table, index=pipeline.index
+    )) == []
+    assert extractor.dsl is extractor.primary_dsl
+    assert opened == [extractor.primary_dsl["host"]]
@@ -0,0 +1,90 @@
+from typing import Any
+
+import pytest
+from elasticsearch.helpers import BulkIndexError
+
+from postgres_to_es.tools.config import ESConfig
+from postgres_to_es.tools.loader import Loader
+
+INDEX = "movies"
+
+
+class FakeES:
+    """Elasticsearch с текущими версиями документов индекса."""
+
+    def __init__(self, versions: dict[str, int]):
+        self.versions = versions
+
+    def mget(self, index: str, ids: list[str], source: bool) -> dict:
+        return {"docs": [
+            {"_id": i, "found": i in self.versions,
+             "_version": self.versions.get(i)}
+            for i in ids
+        ]}
+
+
+def make_loader(versions: dict[str, int]) -> tuple[Loader, list]:
+    loader = Loader(ESConfig(), [])
+    loader.connection = FakeES(versions)
+    written: list[tuple[list[dict[str, Any]], str]] = []
+    loader.bulk = lambda data, index: written.append((data, index))
+    return loader, written
+
+
+def document(doc_id: str, version: int) -> dict[str, Any]:
+    return {
+        "_id": doc_id,
+        "id": doc_id,
+        "_version": version,
+        "_version_type": "external",
+    }
+
+
+def test_skip_conflicts_returns_conflicting_ids():
+    errors = [
+        {"index": {"_id": "a", "status": 409}},
+        {"index": {"_id": "b", "status": 400}},
+    ]
+    other, conflicts = Loader._skip_conflicts(errors, INDEX)
+
+    assert other == [errors[1]]
+    assert conflicts == ["a"]
+
+
+def test_lowered_keeps_only_higher_index_versions():
+    loader, _ = make_loader({"a": 10, "b": 5, "c": 7})
+    data = [document("a", 5), document("b", 5), document("c", 9)]
+
+    assert loader._lowered(data, ["a", "b", "c"], INDEX) == ["a"]
+
+
+def test_overwrite_uses_max_version_with_external_gte():
+    loader, written = make_loader({"a": 10, "b": 3})
+    data = [document("a", 5), document("b", 8), document("c", 1)]
+
+    loader.overwrite(data, INDEX)
+
+    [(items, index)] = written
+    assert index == INDEX
+    assert [(i["_version"], i["_version_type"]) for i in items] == [
+        (10, "external_gte"),
+        (8, "external_gte"),
+        (1, "external"),
+    ]
+
+
+def test_delete_error_is_not_retried():
+    loader = Loader(ESConfig(), [])
+    calls = []
+
+    def bulk_actions(actions, index):
+        calls.append(actions)
+        return 0, [{"delete": {"_id": "a", "status": 500}}]
+
+    loader._bulk_actions = bulk_actions
+
+    with pytest.raises(BulkIndexError):
+        loader.delete([("a", 3), ("b", None)], INDEX)
+    assert len(calls) == 1
+    assert calls[0][0]["_version_type"] == "external_gte"
+    assert "_version" not in calls[0][1]
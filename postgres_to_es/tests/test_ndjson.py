@@ -0,0 +1,89 @@
+import json
+import os
+from typing import Any
+
+import pytest
+
+from postgres_to_es import main
+from postgres_to_es.tools.ndjson import (
+    INDEX_FILE,
+    REPLAY_STORAGE,
+    NDJSONSink,
+    NDJSONSource,
+)
+from postgres_to_es.tools.state import JsonFileStorage, State
+
+BATCHES = [
+    ("movies", [{"_id": "f1", "title": "A\nB"}, {"_id": "f2", "title": "C"}]),
+    ("persons", [{"_id": "p1", "full_name": "Person"}]),
+    ("movies", [{"_id": "f3", "title": "D"}]),
+]
+
+
+class FakeLoader:
+    """Loader, запоминающий загруженные пачки."""
+
+    loaded: list[tuple[str, list[dict[str, Any]]]] = []
+
+    def __init__(self, config, pipelines):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def bulk(self, data: list[dict[str, Any]], index: str) -> list[str]:
+        self.loaded.append((index, data))
+        return []
+
+
+@pytest.fixture
+def sink_dir(tmp_path) -> str:
+    path = str(tmp_path / "sink")
+    # маленькие сегменты: пачки попадают в разные сегменты
+    with NDJSONSink(path, segment_bytes=1) as sink:
+        for index, items in BATCHES:
+            sink.bulk(items, index)
+    return path
+
+
+@pytest.fixture
+def loaded(monkeypatch) -> list:
+    monkeypatch.setattr(main, "Loader", FakeLoader)
+    monkeypatch.setattr(FakeLoader, "loaded", [])
+    return FakeLoader.loaded
+
+
+def test_sink_replay_round_trip(sink_dir, loaded):
+    main.replay(sink_dir, "_v2")
+
+    assert loaded == [(index + "_v2", items) for index, items in BATCHES]
+    replay_state = State(
+        JsonFileStorage(os.path.join(sink_dir, REPLAY_STORAGE))
+    )
+    assert replay_state.get_state("replay_v2_last_batch") == 2
+
+    # повторный запуск ничего не загружает, другой суффикс - все
+    main.replay(sink_dir, "_v2")
+    assert len(loaded) == len(BATCHES)
+    main.replay(sink_dir, "_v3")
+    assert len(loaded) == 2 * len(BATCHES)
+
+
+def test_partial_index_line_is_dropped(sink_dir, tmp_path):
+    index_path = os.path.join(sink_dir, INDEX_FILE)
+    with open(index_path, "a") as f:
+        f.write('{"index": "movies", "segm')
+
+    state = State(JsonFileStorage(str(tmp_path / "replay.json")))
+    batches = list(NDJSONSource(sink_dir, state).batches())
+    assert [index for index, _, _ in batches] == [i for i, _ in BATCHES]
+
+    with NDJSONSink(sink_dir, segment_bytes=1) as sink:
+        sink.bulk([{"_id": "f4"}], "movies")
+    with open(index_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert len(entries) == len(BATCHES) + 1
+    assert entries[-1]["count"] == 1
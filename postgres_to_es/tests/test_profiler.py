@@ -0,0 +1,26 @@
+import os
+
+from postgres_to_es.tools.config import ProfileConfig
+from postgres_to_es.tools.profiler import CycleProfiler
+
+
+def reports(path) -> list[str]:
+    return sorted(os.listdir(path)) if os.path.exists(path) else []
+
+
+def test_overlapping_sample_moves_to_next_cycle(tmp_path):
+    profiler = CycleProfiler(
+        ProfileConfig(enabled=True, cycles=1, every=0), str(tmp_path)
+    )
+
+    # первые циклы пайплайнов стартуют одновременно
+    with profiler.profile("movies", 1, {}):
+        with profiler.profile("persons", 1, {}):
+            pass
+    assert reports(tmp_path) == ["movies_000001.txt"]
+
+    with profiler.profile("persons", 2, {}):
+        pass
+    with profiler.profile("persons", 3, {}):
+        pass
+    assert reports(tmp_path) == ["movies_000001.txt", "persons_000002.txt"]
@@ -0,0 +1,45 @@
+import pytest
+
+from postgres_to_es.tools.reconcile import DELETE, INDEX, merge_diff
+
+
+def diff(source, target, with_version=True):
+    return list(merge_diff(iter(source), iter(target), with_version))
+
+
+def test_missing_and_extra_documents():
+    source = [("a", 1), ("c", 1)]
+    target = [("b", 1), ("c", 1), ("d", 2)]
+
+    assert diff(source, target) == [
+        (INDEX, "a", 1),
+        (DELETE, "b", 1),
+        (DELETE, "d", 2),
+    ]
+
+
+@pytest.mark.parametrize(
+    "source_version, target_version, stale",
+    [
+        (5, 5, False),
+        (6, 5, True),
+        # версия фильма уменьшилась после удаления связи
+        (4, 5, True),
+        (5, None, True),
+        (None, 5, False),
+    ],
+)
+def test_version_mismatch_is_stale(source_version, target_version, stale):
+    result = diff([("a", source_version)], [("a", target_version)])
+
+    assert result == ([(INDEX, "a", source_version)] if stale else [])
+
+
+def test_versions_ignored_without_with_version():
+    assert diff([("a", 4)], [("a", 5)], with_version=False) == []
+
+
+def test_empty_streams():
+    assert diff([], []) == []
+    assert diff([("a", 1)], []) == [(INDEX, "a", 1)]
+    assert diff([], [("a", 1)]) == [(DELETE, "a", 1)]
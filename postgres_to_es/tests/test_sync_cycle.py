@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta, timezone
+from threading import Thread
+
+from postgres_to_es.tools.state import State
+from postgres_to_es.tools.sync_cycle import START_TIME_KEY, SyncCycle
+
+NOW = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+
+
+def start_all(cycle: SyncCycle, candidates: list[datetime]) -> list[str]:
+    """Каждый пайплайн в своем потоке предлагает дату старта."""
+    results: list[str] = []
+    threads = [
+        Thread(target=lambda c=c: results.append(cycle.start_time(c)))
+        for c in candidates
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    return results
+
+
+def test_start_time_is_minimum_of_candidates(state: State):
+    cycle = SyncCycle(state, 3)
+    replica = NOW - timedelta(seconds=5)
+
+    results = start_all(cycle, [NOW, replica, NOW + timedelta(seconds=1)])
+
+    assert results == [str(replica)] * 3
+    assert state.get_state(START_TIME_KEY) == str(replica)
+
+
+def test_unfinished_cycle_keeps_start_time(state: State):
+    state.set_state(START_TIME_KEY, str(NOW - timedelta(hours=1)))
+    cycle = SyncCycle(state, 2)
+
+    results = start_all(cycle, [NOW, NOW])
+
+    assert results == [str(NOW - timedelta(hours=1))] * 2
+
+
+def test_commit_clears_start_time(state: State):
+    cycle = SyncCycle(state, 2)
+    start_all(cycle, [NOW, NOW])
+
+    cycle.defer({"movies_last_modified": str(NOW)})
+    threads = [Thread(target=cycle.wait) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert state.get_state(START_TIME_KEY) is None
+    assert state.get_state("movies_last_modified") == str(NOW)
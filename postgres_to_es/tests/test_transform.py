@@ -0,0 +1,103 @@
+import json
+import tracemalloc
+from typing import Any
+from uuid import UUID
+
+import pytest
+
+from postgres_to_es.tools.transform import CompactTransform, Transform
+
+MOVIE_COLUMNS = (
+    "id",
+    "title",
+    "description",
+    "rating",
+    "type",
+    "created",
+    "modified",
+    "version",
+    "persons",
+    "genres",
+)
+ROWS = 2000
+# документ фильма с тремя персонами и жанром занимает около 1.9 KiB
+MAX_BYTES_PER_ROW = 3 * 1024
+
+
+def _uuid(number: int) -> str:
+    return str(UUID(int=number))
+
+
+def movie_row(number: int) -> tuple:
+    persons = [
+        {
+            "person_role": role,
+            "person_id": _uuid(1000 + position),
+            "person_name": f"Person {position}",
+        }
+        for position, role in enumerate(("actor", "writer", "director"))
+    ]
+    genres = [{"genre_id": _uuid(2000), "genre_name": "Drama"}]
+    return (
+        _uuid(number),
+        f"Title {number}",
+        "Description",
+        7.5,
+        "movie",
+        None,
+        None,
+        1_600_000_000_000_000 + number,
+        persons,
+        genres,
+    )
+
+
+def description(columns: tuple) -> list[tuple]:
+    """Описание курсора: имя колонки первым элементом."""
+    return [(column, None, None, None, None, None, None) for column in columns]
+
+
+def normalize(document: dict[str, Any]) -> dict[str, Any]:
+    """Transform отдает UUID из моделей pydantic, CompactTransform - строки."""
+    return json.loads(json.dumps(document, default=str))
+
+
+@pytest.mark.parametrize(
+    "model, columns, row",
+    [
+        ("FilmWorkES", MOVIE_COLUMNS, movie_row(1)),
+        (
+            "PersonES",
+            ("id", "full_name", "modified", "version"),
+            (_uuid(3), "Person", None, 5),
+        ),
+        (
+            "GenresES",
+            ("id", "name", "description", "modified", "version"),
+            (_uuid(4), "Drama", None, None, 6),
+        ),
+        (None, ("id", "name", "version"), (_uuid(5), "raw", None)),
+    ],
+)
+def test_compact_matches_transform(model, columns, row):
+    compact = CompactTransform(model, description(columns))(row)
+    expected = Transform(dict(zip(columns, row)), model).transform()
+
+    assert normalize(compact) == normalize(expected)
+
+
+def test_compact_movie_bytes_per_row():
+    transform = CompactTransform("FilmWorkES", description(MOVIE_COLUMNS))
+    rows = [movie_row(number) for number in range(ROWS)]
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        documents = [transform(row) for row in rows]
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert len(documents) == ROWS
+    assert (peak - before) / ROWS <= MAX_BYTES_PER_ROW
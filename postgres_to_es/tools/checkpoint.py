@@ -0,0 +1,155 @@
+from collections import deque
+from threading import RLock
+from typing import Any, Callable, Optional
+
+from postgres_to_es.tools.state import State
+
+
+class _Batch:
+    """Выданная пачка, ожидающая подтверждения."""
+
+    __slots__ = ("key", "value", "parent", "acked", "open_children", "done")
+
+    def __init__(self, key: str, value: Any, parent: Optional[int]):
+        self.key = key
+        self.value = value
+        self.parent = parent
+        self.acked = False
+        self.open_children = 0
+        self.done = False
+
+
+class CheckpointTracker:
+    """
+    Упорядоченная фиксация состояний пачек.
+
+    Каждой выданной пачке присваивается порядковый номер.
+    Подтверждения (успешная загрузка в Elasticsearch) могут приходить
+    в любом порядке, но сохраненное состояние ключа сдвигается только
+    через непрерывную последовательность завершенных пачек.
+
+    Пачка может иметь родителя (например пачка uuid из reference таблицы
+    для пачек М2М). Родитель завершен, когда подтвержден сам и завершены
+    все его дочерние пачки. Состояние дочернего ключа имеет смысл только
+    внутри незавершенного родителя, поэтому при завершении родителя
+    оно сбрасывается в None в той же записи, что и состояние родителя.
+    """
+
+    def __init__(self, state: State) -> None:
+        self.state = state
+        self._seq = 0
+        self._batches: dict[int, _Batch] = {}
+        self._queues: dict[str, deque[int]] = {}
+        self._persisted_parent: dict[str, Optional[int]] = {}
+        self._drain_callbacks: list[Callable[[], None]] = []
+        self._lock = RLock()
+
+    def begin(self, key: str, value: Any, parent: int = None) -> int:
+        """
+        Регистрирует выданную пачку.
+        :param key: ключ состояния
+        :param value: значение состояния после загрузки пачки
+        :param parent: номер родительской пачки
+        :return: порядковый номер пачки
+        """
+        with self._lock:
+            self._seq += 1
+            self._batches[self._seq] = _Batch(key, value, parent)
+            self._queues.setdefault(key, deque()).append(self._seq)
+            if parent is not None:
+                self._batches[parent].open_children += 1
+            return self._seq
+
+    def ack(self, seq: Optional[int]) -> None:
+        """
+        Подтверждает пачку и сохраняет состояния,
+        которые можно сдвинуть.
+        :param seq: порядковый номер пачки
+        """
+        if seq is None:
+            return
+        with self._lock:
+            batch = self._batches.get(seq)
+            if batch is None or batch.acked:
+                return
+            batch.acked = True
+            changes: dict[str, Any] = {}
+            self._settle(seq, changes)
+            if changes:
+                self.state.butch_set_state(changes)
+            if not self._batches:
+                self._drain()
+
+    def attach(self, key: str, parent: int) -> None:
+        """
+        Привязывает уже сохраненное состояние ключа к родительской пачке:
+        после перезапуска сохраненный uuid дочернего ключа относится
+        к первой выданной пачке родителя, даже если новых дочерних пачек
+        не будет. При завершении родителя состояние сбрасывается в None.
+        :param key: дочерний ключ состояния
+        :param parent: номер родительской пачки
+        """
+        with self._lock:
+            if not self._queues.get(key):
+                self._persisted_parent[key] = parent
+
+    def on_drain(self, callback: Callable[[], None]) -> None:
+        """
+        Выполняет callback, когда все выданные пачки подтверждены.
+        Если таких пачек нет, callback выполняется сразу.
+        :param callback: функция без аргументов
+        """
+        with self._lock:
+            self._drain_callbacks.append(callback)
+            if not self._batches:
+                self._drain()
+
+    def pending(self) -> int:
+        """Количество незавершенных пачек."""
+        with self._lock:
+            return len(self._batches)
+
+    def _settle(self, seq: int, changes: dict[str, Any]) -> None:
+        """
+        Отмечает пачку завершенной, если она подтверждена
+        и у нее нет незавершенных дочерних пачек,
+        и продвигает состояния ключа и родителя.
+        """
+        batch = self._batches[seq]
+        if batch.done or not batch.acked or batch.open_children:
+            return
+        batch.done = True
+        self._flush(batch.key, changes)
+        for key, parent in self._persisted_parent.items():
+            if parent == seq:
+                changes[key] = None
+                self._persisted_parent[key] = None
+        if batch.parent is not None and batch.parent in self._batches:
+            self._batches[batch.parent].open_children -= 1
+            self._settle(batch.parent, changes)
+
+    def _flush(self, key: str, changes: dict[str, Any]) -> None:
+        """
+        Сдвигает состояние ключа через непрерывную
+        последовательность завершенных пачек.
+        """
+        queue = self._queues[key]
+        last = None
+        while queue and self._batches[queue[0]].done:
+            last = self._batches.pop(queue.popleft())
+        if last is None:
+            return
+        if last.parent is not None and (
+            last.parent not in self._batches
+            or self._batches[last.parent].done
+        ):
+            changes[key] = None
+            self._persisted_parent[key] = None
+        else:
+            changes[key] = last.value
+            self._persisted_parent[key] = last.parent
+
+    def _drain(self) -> None:
+        callbacks, self._drain_callbacks = self._drain_callbacks, []
+        for callback in callbacks:
+            callback()
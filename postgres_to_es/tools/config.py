@@ -1,15 +1,21 @@
+import json
 import logging
 import os
+import socket
 from pathlib import Path
+from typing import Optional
+from uuid import UUID
 
 import dotenv
-from pydantic import BaseSettings, Field
+from pydantic import BaseModel, BaseSettings, Field
 
 dotenv.load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 ES_SCHEME = os.path.join(BASE_DIR, "el_settings/es_shema.json")
 STORAGE = os.path.join(BASE_DIR, "storage/storage.json")
+PIPELINES = os.path.join(BASE_DIR, "el_settings/pipelines.json")
+PROFILE_DIR = os.path.join(BASE_DIR, "storage/profile")
 
 
 class PostgresConfig(BaseSettings):
@@ -36,6 +42,153 @@ class BackOffConfig(BaseSettings):
 class MainConfig(BackOffConfig):
     chunk_size: int = Field(..., env="MAIN_CHUNK")
     delay: int = Field(..., env="MAIN_DELAY")
+    copy_initial: bool = Field(False, env="MAIN_COPY_INITIAL")
+    compact_rows: bool = Field(False, env="MAIN_COMPACT_ROWS")
+    dimension_cache: bool = Field(False, env="MAIN_DIMENSION_CACHE")
+    person_cache_size: int = Field(100000, env="MAIN_PERSON_CACHE_SIZE")
+    priority_latency: float = Field(0, env="MAIN_PRIORITY_LATENCY")
+    sync_cycle: bool = Field(False, env="MAIN_SYNC_CYCLE")
+    pipelines: str = Field(PIPELINES, env="MAIN_PIPELINES")
+
+
+class ProfileConfig(BaseSettings):
+    enabled: bool = Field(False, env="PROFILE_ENABLE")
+    cycles: int = Field(1, env="PROFILE_CYCLES")
+    every: int = Field(0, env="PROFILE_EVERY")
+    top: int = Field(30, env="PROFILE_TOP")
+    frames: int = Field(1, env="PROFILE_FRAMES")
+
+
+class SinkConfig(BaseSettings):
+    segment_bytes: int = Field(64 * 1024 * 1024, env="SINK_SEGMENT_BYTES")
+
+
+class CoordinationConfig(BaseSettings):
+    enabled: bool = Field(False, env="COORD_ENABLE")
+    partitions: int = Field(1, env="COORD_PARTITIONS")
+    workers: int = Field(1, env="COORD_WORKERS")
+    lease_ttl: int = Field(30, env="COORD_LEASE_TTL")
+    owner: str = Field(
+        f"{socket.gethostname()}-{os.getpid()}", env="COORD_OWNER"
+    )
+
+
+class GovernorConfig(BaseSettings):
+    rows_per_sec: float = Field(0, env="GOV_ROWS_PER_SEC")
+    queries_per_sec: float = Field(0, env="GOV_QUERIES_PER_SEC")
+    statement_timeout: dict[str, str] = Field({}, env="GOV_STATEMENT_TIMEOUT")
+    work_mem: dict[str, str] = Field({}, env="GOV_WORK_MEM")
+    latency_target: float = Field(0, env="GOV_LATENCY_TARGET")
+    max_slowdown: float = Field(8, env="GOV_MAX_SLOWDOWN")
+    cancel_retries: int = Field(3, env="GOV_CANCEL_RETRIES")
+    replica_host: Optional[str] = Field(None, env="GOV_REPLICA_HOST")
+    replica_port: Optional[str] = Field(None, env="GOV_REPLICA_PORT")
+    max_replica_lag: float = Field(30, env="GOV_REPLICA_MAX_LAG")
+
+
+class Partition(BaseModel):
+    """
+    Диапазон uuid [lower, upper) части пайплайна.
+    Для последней части upper не задан.
+    """
+
+    number: int
+    count: int
+    lower: str
+    upper: Optional[str] = None
+
+    @property
+    def suffix(self) -> str:
+        return f"_p{self.number}of{self.count}"
+
+    @property
+    def params(self) -> list[str]:
+        if self.upper is None:
+            return [self.lower]
+        return [self.lower, self.upper]
+
+    @classmethod
+    def split(cls, count: int) -> list["Partition"]:
+        """
+        Делит пространство uuid на count равных диапазонов.
+        :param count: количество частей
+        :return: список частей
+        """
+        bounds = [str(UUID(int=(i << 128) // count)) for i in range(count)]
+        return [
+            cls(
+                number=i,
+                count=count,
+                lower=bounds[i],
+                upper=bounds[i + 1] if i + 1 < count else None,
+            )
+            for i in range(count)
+        ]
+
+
+class ReferenceConfig(BaseModel):
+    """
+    Reference таблица, изменения в которой
+    требуют перезагрузки документов пайплайна через таблицу М2М.
+    """
+
+    table: str
+    m2m_table: str
+    m2m_column: str
+    m2m_target: str
+
+
+class PipelineConfig(BaseModel):
+    """
+    Описание пайплайна Postgres -> Elasticsearch.
+    query - путь к SQL шаблону с подстановкой {where} относительно
+    файла пайплайнов, при загрузке заменяется текстом шаблона.
+    Если не задан, запрос собирается из table и columns.
+    Запрос должен отдавать колонку id.
+    light_query - облегченный шаблон для режима кеша справочников:
+    вместо персон и жанров отдает person_roles (пары id, роль)
+    и genre_ids, документ собирается в DimensionCache.
+    versioned - документы загружаются с внешней версией из колонки version
+    (микросекунды modified), для шаблона колонку version отдает сам запрос.
+    model - имя модели из models для валидации,
+    если не задана, строка загружается как есть.
+    batch_size и delay - собственный бюджет пайплайна,
+    по умолчанию MAIN_CHUNK и MAIN_DELAY.
+    """
+
+    name: str
+    index: str
+    mapping: str
+    table: str
+    model: Optional[str] = None
+    query: Optional[str] = None
+    light_query: Optional[str] = None
+    columns: list[str] = ["id", "modified"]
+    id_column: str = "id"
+    modified_column: str = "modified"
+    versioned: bool = True
+    references: list[ReferenceConfig] = []
+    batch_size: Optional[int] = None
+    delay: Optional[int] = None
+
+
+def load_pipelines(path: str) -> list[PipelineConfig]:
+    """
+    Загружает описание пайплайнов.
+    SQL шаблоны читаются из файлов при загрузке.
+    :param path: путь к json файлу пайплайнов
+    :return: список пайплайнов
+    """
+    with open(path) as f:
+        pipelines = [PipelineConfig(**item) for item in json.load(f)]
+    for pipeline in pipelines:
+        for field in ("query", "light_query"):
+            query = getattr(pipeline, field)
+            if query is not None:
+                query_path = os.path.join(os.path.dirname(path), query)
+                with open(query_path) as f:
+                    setattr(pipeline, field, f.read())
+    return pipelines
 
 
 LOGGING = {
@@ -0,0 +1,262 @@
+import logging
+from threading import Event, RLock, Thread
+from typing import Any, Callable, Dict, Optional
+
+import psycopg2
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.extensions import connection as _connection
+from psycopg2.extensions import cursor as _cursor
+from psycopg2.extras import Json
+
+from postgres_to_es.tools.backoff import backoff, boff_config
+from postgres_to_es.tools.config import PostgresConfig
+from postgres_to_es.tools.state import BaseStorage
+
+log = logging.getLogger(__name__)
+
+STATE_TABLE = "public.etl_state"
+LEASE_TABLE = "public.etl_lease"
+
+
+class LeaseLost(Exception):
+    """Аренда части работы истекла или перехвачена другим экземпляром."""
+
+
+class PostgresClient:
+    """
+    Подключение к Postgres для координации экземпляров ETL.
+    Запросы выполняются в транзакции,
+    при потере связи происходит переподключение.
+    """
+
+    def __init__(self, dsl: PostgresConfig):
+        self.dsl = dsl.dict()
+        self.connection: Optional[_connection] = None
+        self._lock = RLock()
+
+    @backoff(**boff_config.dict())
+    def connect(self):
+        """
+        Создается подлючение к Postgres.
+        Ошибка если Postgres недоступен.
+        """
+        self.connection = psycopg2.connect(**self.dsl)
+
+    def transaction(self, func: Callable[[_cursor], Any]) -> Any:
+        """
+        Выполняет функцию в транзакции.
+        :param func: функция, принимающая курсор
+        :return: результат выполнения функции
+        """
+        with self._lock:
+            while True:
+                try:
+                    with self.connection:
+                        with self.connection.cursor() as curs:
+                            return func(curs)
+                except (OperationalError, InterfaceError) as error:
+                    log.info(f"Postgres connect ERROR {error}")
+                    self.connect()
+
+    def setup(self) -> None:
+        """
+        Создает таблицы состояний и аренды, если их еще нет.
+        """
+        def create(curs: _cursor) -> None:
+            curs.execute(f"""
+            CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+                key text PRIMARY KEY,
+                value jsonb
+            )""")
+            curs.execute(f"""
+            CREATE TABLE IF NOT EXISTS {LEASE_TABLE} (
+                unit text PRIMARY KEY,
+                owner text NOT NULL,
+                expires_at timestamp with time zone NOT NULL
+            )""")
+
+        self.transaction(create)
+
+    def __enter__(self):
+        self.connect()
+        self.setup()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.close()
+        log.info("Postgres coordination connection close")
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний в таблице Postgres, общее для экземпляров ETL.
+    Если задан fence (unit, owner), состояние сохраняется
+    только пока аренда unit принадлежит owner: строка аренды блокируется
+    в той же транзакции, поэтому экземпляр, потерявший аренду,
+    не может откатить состояние нового владельца.
+    """
+
+    def __init__(
+        self, client: PostgresClient, fence: tuple[str, str] = None
+    ) -> None:
+        self.client = client
+        self.fence = fence
+
+    def save_state(self, state: Dict[str, Any]) -> None:
+        """Сохранить состояние в хранилище."""
+        def save(curs: _cursor) -> None:
+            if self.fence is not None:
+                curs.execute(
+                    f"SELECT 1 FROM {LEASE_TABLE}"
+                    " WHERE unit = %s AND owner = %s AND expires_at > now()"
+                    " FOR SHARE",
+                    self.fence
+                )
+                if curs.fetchone() is None:
+                    raise LeaseLost(self.fence[0])
+            curs.executemany(
+                f"INSERT INTO {STATE_TABLE} (key, value) VALUES (%s, %s)"
+                " ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+                [(key, Json(value)) for key, value in state.items()]
+            )
+
+        self.client.transaction(save)
+
+    def seed_state(self, state: Dict[str, Any]) -> None:
+        """
+        Сохранить состояния, которых еще нет в хранилище.
+        Уже сохраненные значения не меняются.
+        """
+        def seed(curs: _cursor) -> None:
+            curs.executemany(
+                f"INSERT INTO {STATE_TABLE} (key, value) VALUES (%s, %s)"
+                " ON CONFLICT (key) DO NOTHING",
+                [(key, Json(value)) for key, value in state.items()]
+            )
+
+        self.client.transaction(seed)
+
+    def retrieve_state(self) -> Dict[str, Any]:
+        """Получить состояние из хранилища."""
+        def retrieve(curs: _cursor) -> Dict[str, Any]:
+            curs.execute(f"SELECT key, value FROM {STATE_TABLE}")
+            return dict(curs.fetchall())
+
+        return self.client.transaction(retrieve)
+
+
+class Lease:
+    """
+    Аренда части работы.
+    Пока аренда удерживается, фоновый поток продлевает ее
+    каждую треть срока аренды. При выходе аренда освобождается
+    с задержкой cooldown, до истечения которой часть никто не возьмет.
+    """
+
+    def __init__(self, manager: "LeaseManager", unit: str, cooldown: int):
+        self.manager = manager
+        self.unit = unit
+        self.cooldown = cooldown
+        self.lost = Event()
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def check(self) -> None:
+        """
+        Ошибка LeaseLost, если аренда потеряна.
+        """
+        if self.lost.is_set():
+            raise LeaseLost(self.unit)
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(self.manager.ttl / 3):
+            if not self.manager.heartbeat(self.unit):
+                log.info(f"Lease {self.unit} lost")
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self._thread = Thread(
+            target=self._heartbeat, name=f"lease-{self.unit}", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        if not self.lost.is_set():
+            self.manager.release(self.unit, self.cooldown)
+
+
+class LeaseManager:
+    """
+    Аренда частей работы (пайплайн и диапазон uuid) через таблицу аренды.
+    Часть может взять любой экземпляр, если ее аренда истекла:
+    так работа экземпляра, переставшего продлевать аренду,
+    переходит к остальным.
+    """
+
+    def __init__(self, client: PostgresClient, owner: str, ttl: int):
+        self.client = client
+        self.owner = owner
+        self.ttl = ttl
+
+    def acquire(self, unit: str, cooldown: int) -> Optional[Lease]:
+        """
+        Пытается взять аренду части.
+        :param unit: название части
+        :param cooldown: задержка повторного запуска части после освобождения
+        :return: аренда или None, если часть занята
+        """
+        def claim(curs: _cursor) -> bool:
+            curs.execute(
+                f"INSERT INTO {LEASE_TABLE} (unit, owner, expires_at)"
+                " VALUES (%s, %s, now() + %s * interval '1 second')"
+                " ON CONFLICT (unit) DO UPDATE"
+                " SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at"
+                f" WHERE {LEASE_TABLE}.expires_at < now()"
+                " RETURNING unit",
+                (unit, self.owner, self.ttl)
+            )
+            return curs.fetchone() is not None
+
+        if not self.client.transaction(claim):
+            return None
+        log.info(f"Lease {unit} acquired by {self.owner}")
+        return Lease(self, unit, cooldown)
+
+    def heartbeat(self, unit: str) -> bool:
+        """
+        Продлевает аренду части.
+        :param unit: название части
+        :return: False, если аренда уже не принадлежит экземпляру
+        """
+        def extend(curs: _cursor) -> bool:
+            curs.execute(
+                f"UPDATE {LEASE_TABLE}"
+                " SET expires_at = now() + %s * interval '1 second'"
+                " WHERE unit = %s AND owner = %s AND expires_at > now()"
+                " RETURNING unit",
+                (self.ttl, unit, self.owner)
+            )
+            return curs.fetchone() is not None
+
+        return self.client.transaction(extend)
+
+    def release(self, unit: str, cooldown: int) -> None:
+        """
+        Освобождает аренду части.
+        :param unit: название части
+        :param cooldown: через сколько секунд часть можно взять снова
+        """
+        def free(curs: _cursor) -> None:
+            curs.execute(
+                f"UPDATE {LEASE_TABLE}"
+                " SET expires_at = now() + %s * interval '1 second'"
+                " WHERE unit = %s AND owner = %s",
+                (cooldown, unit, self.owner)
+            )
+
+        self.client.transaction(free)
+        log.info(f"Lease {unit} released by {self.owner}")
@@ -0,0 +1,157 @@
+import json
+import logging
+import re
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Any, Iterator, Optional
+
+from psycopg2.extensions import connection as _connection
+
+log = logging.getLogger(__name__)
+
+# Экранирование текстового формата COPY
+# https://www.postgresql.org/docs/current/sql-copy.html
+_COPY_ESCAPES = {
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+    "\\": "\\",
+}
+_COPY_ESCAPE_RE = re.compile(r"\\(.)")
+_END = object()
+
+
+class _StopCopy(Exception):
+    """Поток COPY остановлен потребителем."""
+
+
+class _QueueWriter:
+    """
+    Файлоподобный объект для copy_expert.
+    Складывает полученные от Postgres куски данных в ограниченную очередь,
+    тем самым чтение из базы не опережает обработку больше чем на maxsize.
+    """
+
+    def __init__(self, queue: Queue, stop: Event):
+        self.queue = queue
+        self.stop = stop
+
+    def write(self, data: Any) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        while True:
+            if self.stop.is_set():
+                raise _StopCopy
+            try:
+                self.queue.put(bytes(data), timeout=0.5)
+                return len(data)
+            except Full:
+                continue
+
+
+class CopyStream:
+    """
+    Потоковое чтение результата COPY (SELECT row_to_json(...)) TO STDOUT.
+    COPY выполняется в отдельном потоке, строки разбираются по мере
+    поступления, без постраничных запросов и без построения DictRow.
+    Каждая строка результата - один JSON документ.
+    """
+
+    def __init__(
+        self,
+        connection: _connection,
+        query: str,
+        max_chunks: int = 1000
+    ):
+        self.connection = connection
+        self.query = query
+        self.queue: Queue = Queue(maxsize=max_chunks)
+        self.stop = Event()
+        self.thread: Optional[Thread] = None
+
+    def _copy(self) -> None:
+        """
+        Выполняет COPY и передает в очередь маркер окончания
+        или возникшую ошибку.
+        """
+        try:
+            with self.connection.cursor() as curs:
+                curs.copy_expert(
+                    self.query,
+                    _QueueWriter(self.queue, self.stop)
+                )
+            self._put(_END)
+        except Exception as error:
+            if self.stop.is_set():
+                return
+            self._put(error)
+
+    def _put(self, item: Any) -> None:
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except Full:
+                continue
+
+    @staticmethod
+    def _unescape(line: str) -> str:
+        """
+        Снимает экранирование текстового формата COPY.
+        :param line: строка в формате COPY
+        :return: исходное значение
+        """
+        if "\\" not in line:
+            return line
+        return _COPY_ESCAPE_RE.sub(
+            lambda m: _COPY_ESCAPES.get(m.group(1), m.group(1)), line
+        )
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        """
+        Запускает COPY и отдает строки результата в виде словаря.
+        При остановке итерации COPY прерывается.
+        :return: данные строки в виде словаря
+        """
+        self.thread = Thread(target=self._copy, daemon=True)
+        self.thread.start()
+        tail = b""
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is _END:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                lines = (tail + chunk).split(b"\n")
+                tail = lines.pop()
+                for line in lines:
+                    yield json.loads(self._unescape(line.decode()))
+            if tail:
+                yield json.loads(self._unescape(tail.decode()))
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """
+        Останавливает COPY, если он еще выполняется.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.stop.set()
+        try:
+            self.connection.cancel()
+        except Exception as error:
+            log.info(f"Postgres COPY cancel ERROR {error}")
+        while self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                self.thread.join(timeout=0.5)
+        try:
+            self.connection.rollback()
+        except Exception as error:
+            log.info(f"Postgres COPY rollback ERROR {error}")
@@ -0,0 +1,204 @@
+import logging
+from collections import OrderedDict
+from typing import Any, Iterable, Optional
+
+from psycopg2.extensions import connection as _connection
+
+from postgres_to_es.tools.maker_guery import get_version_column
+
+log = logging.getLogger(__name__)
+
+_VERSION = get_version_column("modified")
+
+
+class GenreCache:
+    """
+    Кеш id -> (название, версия) всех жанров.
+    Таблица жанров маленькая, загружается целиком
+    и обновляется по колонке modified.
+    """
+
+    def __init__(self) -> None:
+        self.items: dict[str, tuple[str, int]] = {}
+        self.watermark = None
+
+    def refresh(self, connection: _connection) -> None:
+        """
+        Загружает жанры, измененные после последнего обновления.
+        """
+        with connection.cursor() as curs:
+            query = f"SELECT id, name, modified, {_VERSION} FROM content.genre"
+            if self.watermark is None:
+                curs.execute(query)
+            else:
+                curs.execute(query + " WHERE modified >= %s", [self.watermark])
+            for genre_id, name, modified, version in curs.fetchall():
+                self.items[str(genre_id)] = (name, version)
+                if self.watermark is None or modified > self.watermark:
+                    self.watermark = modified
+
+    def get_many(
+        self, connection: _connection, ids: Iterable[str]
+    ) -> dict[str, tuple[str, int]]:
+        """
+        Жанры по списку id. Отсутствующие в кеше жанры загружаются
+        по id: жанр из поздно зафиксированной транзакции может иметь
+        modified раньше watermark и не попасть в обновление.
+        """
+        missing = [genre_id for genre_id in ids if genre_id not in self.items]
+        if missing:
+            with connection.cursor() as curs:
+                curs.execute(
+                    f"SELECT id, name, {_VERSION}"
+                    " FROM content.genre WHERE id = ANY(%s::uuid[])",
+                    [missing]
+                )
+                for genre_id, name, version in curs.fetchall():
+                    self.items[str(genre_id)] = (name, version)
+        return self.items
+
+
+class PersonCache:
+    """
+    Ограниченный LRU кеш id -> (имя, версия) персон.
+    Отсутствующие персоны загружаются по запросу,
+    измененные персоны обновляются по колонке modified,
+    если они есть в кеше.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.items: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self.watermark = None
+
+    def refresh(self, connection: _connection) -> None:
+        """
+        Обновляет персоны кеша, измененные после последнего обновления.
+        При первом вызове только запоминает время последнего изменения.
+        """
+        with connection.cursor() as curs:
+            if self.watermark is None:
+                curs.execute("SELECT max(modified) FROM content.person")
+                self.watermark = curs.fetchone()[0]
+                return
+            curs.execute(
+                f"SELECT id, full_name, modified, {_VERSION}"
+                " FROM content.person WHERE modified >= %s",
+                [self.watermark]
+            )
+            for person_id, name, modified, version in curs:
+                person_id = str(person_id)
+                if person_id in self.items:
+                    self.items[person_id] = (name, version)
+                if modified > self.watermark:
+                    self.watermark = modified
+
+    def get_many(
+        self, connection: _connection, ids: Iterable[str]
+    ) -> dict[str, tuple[str, int]]:
+        """
+        Персоны по списку id, отсутствующие в кеше загружаются одним запросом.
+        """
+        found: dict[str, tuple[str, int]] = {}
+        missing = []
+        for person_id in ids:
+            item = self.items.get(person_id)
+            if item is None:
+                missing.append(person_id)
+            else:
+                self.items.move_to_end(person_id)
+                found[person_id] = item
+        if missing:
+            with connection.cursor() as curs:
+                curs.execute(
+                    f"SELECT id, full_name, {_VERSION}"
+                    " FROM content.person WHERE id = ANY(%s::uuid[])",
+                    [missing]
+                )
+                for person_id, name, version in curs.fetchall():
+                    found[str(person_id)] = self._put(
+                        str(person_id), (name, version)
+                    )
+        return found
+
+    def _put(self, person_id: str, item: tuple[str, int]) -> tuple[str, int]:
+        self.items[person_id] = item
+        self.items.move_to_end(person_id)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+        return item
+
+
+class DimensionCache:
+    """
+    Сборка фильмов из облегченного запроса (id персон с ролями и id жанров)
+    и кешей справочников, без соединений с person и genre в Postgres.
+    Кеши обновляются один раз за цикл, перед первой сборкой.
+    """
+
+    def __init__(self, person_cache_size: int) -> None:
+        self.genres = GenreCache()
+        self.persons = PersonCache(person_cache_size)
+        self.stale = True
+
+    def assemble(
+        self, connection: _connection, rows: list[Any]
+    ) -> list[dict[str, Any]]:
+        """
+        Собирает строки фильмов в формат полного запроса:
+        persons и genres в виде списков словарей, version - максимум
+        из версий фильма, его персон и жанров.
+        :param connection: подключение к Postgres
+        :param rows: строки облегченного запроса
+        :return: строки фильмов в виде словарей
+        """
+        if self.stale:
+            self.genres.refresh(connection)
+            self.persons.refresh(connection)
+            self.stale = False
+            log.info(
+                f"Dimension cache: {len(self.genres.items)} genres,"
+                f" {len(self.persons.items)} persons"
+            )
+        person_ids = {
+            str(person[0]) for row in rows for person in row["person_roles"]
+        }
+        genre_ids = {
+            str(genre_id) for row in rows for genre_id in row["genre_ids"]
+        }
+        persons = self.persons.get_many(connection, person_ids)
+        genres = self.genres.get_many(connection, genre_ids)
+        films = []
+        for row in rows:
+            film = dict(row)
+            version: Optional[int] = film["version"]
+            film["persons"] = []
+            for person_id, role in dict.fromkeys(
+                (str(person[0]), person[1]) for person in film.pop(
+                    "person_roles"
+                )
+            ):
+                person = persons.get(person_id)
+                if person is None:
+                    continue
+                film["persons"].append({
+                    "person_role": role,
+                    "person_id": person_id,
+                    "person_name": person[0],
+                })
+                version = max(version or 0, person[1])
+            film["genres"] = []
+            for genre_id in dict.fromkeys(
+                str(genre_id) for genre_id in film.pop("genre_ids")
+            ):
+                genre = genres.get(genre_id)
+                if genre is None:
+                    continue
+                film["genres"].append({
+                    "genre_name": genre[0],
+                    "genre_id": genre_id,
+                })
+                version = max(version or 0, genre[1])
+            film["version"] = version
+            films.append(film)
+        return films
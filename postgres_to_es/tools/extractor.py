@@ -1,31 +1,103 @@
 import logging
+from collections import defaultdict
+from contextlib import closing
 from datetime import datetime, timezone
 from functools import wraps
+from time import perf_counter, sleep
 from typing import Any, Callable, Iterable, Optional
 
 import psycopg2
 from more_itertools import chunked
 from psycopg2 import InterfaceError, OperationalError
+from psycopg2.errors import QueryCanceled
 from psycopg2.extensions import connection as _connection
+from psycopg2.extensions import cursor as _cursor
 from psycopg2.extras import DictCursor
 
 from postgres_to_es.tools.backoff import backoff, boff_config
-from postgres_to_es.tools.config import PostgresConfig
-from postgres_to_es.tools.maker_guery import get_query, get_query_single
+from postgres_to_es.tools.checkpoint import CheckpointTracker
+from postgres_to_es.tools.config import (
+    GovernorConfig,
+    Partition,
+    PipelineConfig,
+    PostgresConfig,
+    ReferenceConfig,
+)
+from postgres_to_es.tools.copy_stream import CopyStream
+from postgres_to_es.tools.dimensions import DimensionCache
+from postgres_to_es.tools.governor import Governor
+from postgres_to_es.tools.maker_guery import (
+    get_query,
+    get_query_copy,
+    get_query_ids,
+    get_query_m2m,
+    get_query_reconcile,
+)
 from postgres_to_es.tools.state import State
-from postgres_to_es.tools.transform import Transform
+from postgres_to_es.tools.sync_cycle import SyncCycle
+from postgres_to_es.tools.transform import CompactTransform, Transform
 
 log = logging.getLogger(__name__)
 
 
 class PostgresExtractor:
-    def __init__(self, dsl: PostgresConfig, batch_size: int, state: State):
-        self.batch_size = batch_size
+    def __init__(
+        self,
+        dsl: PostgresConfig,
+        pipeline: PipelineConfig,
+        batch_size: int,
+        state: State,
+        copy_initial: bool = False,
+        compact_rows: bool = False,
+        partition: Partition = None,
+        dimension_cache: bool = False,
+        person_cache_size: int = 100000,
+        priority_latency: float = 0,
+        cycle: SyncCycle = None,
+        governor: GovernorConfig = None,
+    ):
+        self.pipeline = pipeline
+        self.bind(state, partition)
+        self.default_batch_size = pipeline.batch_size or batch_size
+        self.batch_size = self.default_batch_size
+        self.copy_initial = copy_initial
+        self.compact_rows = compact_rows
+        self.dimensions: Optional[DimensionCache] = None
+        if dimension_cache and pipeline.light_query is not None:
+            self.dimensions = DimensionCache(person_cache_size)
+        self.priority_latency = priority_latency
+        self.cycle = cycle
+        self._priority_modified: Optional[datetime] = None
+        self._priority_polled = 0.0
         self.connection: Optional[_connection] = None
-        self.dsl = dsl.dict()
-        self.state = state
+        self.dimension_connection: Optional[_connection] = None
+        self.governor = Governor(governor or GovernorConfig())
+        self.primary_dsl = dsl.dict()
+        self.replica_dsl: Optional[dict[str, Any]] = None
+        if self.governor.config.replica_host:
+            self.replica_dsl = {
+                **self.primary_dsl,
+                "host": self.governor.config.replica_host,
+                "port": self.governor.config.replica_port
+                or self.primary_dsl["port"],
+            }
+        self.dsl = self.primary_dsl
         self.start_time: Optional[datetime] = None
         self.last_modified: Optional[datetime] = None
+        self.phases: dict[str, float] = defaultdict(float)
+
+    def bind(self, state: State, partition: Partition = None) -> None:
+        """
+        Переключает extractor на часть работы: стейт, диапазон uuid
+        и подтверждения пачек. Подключения, кеш справочников
+        и замедление Governor сохраняются между частями.
+        :param state: состояния части
+        :param partition: диапазон uuid части
+        """
+        self.state = state
+        self.partition = partition
+        self.key_suffix = partition.suffix if partition is not None else ""
+        self.checkpoints = CheckpointTracker(state)
 
     @backoff(**boff_config.dict())
     def connect(self):
@@ -33,211 +105,515 @@ class PostgresExtractor:
         Создается подлючение к Postgres.
         Ошибка если Postgres недоступен.
         """
+        self._open()
+
+    def _open(self):
         self.connection = psycopg2.connect(
             **self.dsl,
             cursor_factory=DictCursor
         )
+        if self.dimensions is not None:
+            # отдельное подключение: во время COPY основное занято
+            self.dimension_connection = psycopg2.connect(**self.dsl)
+            self.dimension_connection.autocommit = True
+
+    def _close(self):
+        self.connection.close()
+        if self.dimension_connection is not None:
+            self.dimension_connection.close()
+
+    def _switch(self, dsl: dict[str, Any], retry: bool = True) -> None:
+        """
+        Переключает подключения на другой источник.
+        :param dsl: параметры подключения
+        :param retry: повторять подключение, пока источник недоступен
+        """
+        if dsl is self.dsl:
+            return
+        self._close()
+        self.dsl = dsl
+        if retry:
+            self.connect()
+        else:
+            self._open()
+
+    def _route(self) -> Optional[datetime]:
+        """
+        Выбор источника на цикл: реплика, если она задана,
+        доступна и отстает не больше max_replica_lag, иначе primary.
+        :return: время, до которого реплика применила изменения,
+            None - выборка из primary
+        """
+        if self.replica_dsl is None:
+            return None
+        try:
+            position = self._wal_position()
+            self._switch(self.replica_dsl, retry=False)
+            replica_time = self.governor.replica_time(
+                self.connection, position
+            )
+        except (OperationalError, InterfaceError) as error:
+            log.info(f"Replica ERROR {error}")
+            replica_time = None
+        if replica_time is None:
+            self._switch(self.primary_dsl)
+        return replica_time
+
+    def _wal_position(self) -> tuple[str, datetime]:
+        """
+        Позиция журнала primary для проверки отставания реплики.
+        Если подключения к primary нет, открывается отдельное.
+        """
+        if self.dsl is self.primary_dsl:
+            return self.governor.wal_position(self.connection)
+        with closing(psycopg2.connect(**self.primary_dsl)) as connection:
+            return self.governor.wal_position(connection)
+
+    def _cursor(self) -> _cursor:
+        """
+        Курсор для выборки документов.
+        В режиме compact_rows строки отдаются кортежами без DictRow.
+        Для сборки через кеш справочников нужны строки DictRow.
+        """
+        if self.compact_rows and self.dimensions is None:
+            return self.connection.cursor(cursor_factory=_cursor)
+        return self.connection.cursor()
+
+    def _transformer(self, curs: _cursor) -> Callable[[Any], dict[str, Any]]:
+        """
+        Функция трансформации строк выполненного запроса.
+        В режиме compact_rows позиции колонок вычисляются один раз на запрос.
+        Собранные через кеш справочников строки трансформируются моделью.
+        :param curs: курсор с выполненным запросом
+        :return: функция трансформации строки
+        """
+        if self.compact_rows and self.dimensions is None:
+            return CompactTransform(self.pipeline.model, curs.description)
+        model = self.pipeline.model
+        return lambda row: Transform(row, model).transform()
+
+    def _assemble(self, rows: list[Any]) -> list[Any]:
+        """
+        В режиме кеша справочников собирает строки облегченного запроса
+        в строки полного запроса.
+        :param rows: строки выполненного запроса
+        :return: строки для трансформации
+        """
+        if self.dimensions is None:
+            return rows
+        started = perf_counter()
+        rows = self.dimensions.assemble(self.dimension_connection, rows)
+        self.phases["assemble"] += perf_counter() - started
+        return rows
+
+    @staticmethod
+    def _id_position(curs: _cursor) -> int:
+        return [column[0] for column in curs.description].index("id")
 
     @staticmethod
     def _reconnect(func: Callable) -> Callable:
         """
         Попытка выполнить функцию генератор.
         При неудаче происходит подключение к базе до тех пор,
-        пока база не будет доступна.
+        пока база не будет доступна. При ошибке на реплике
+        подключения переключаются на primary.
+        Запрос, отмененный по statement_timeout, переподключением
+        не исправить: он повторяется не больше cancel_retries раз подряд
+        с паузой и вдвое меньшей пачкой, затем ошибка поднимается.
         :param func: функция генератор
         :return: результат выполнения функции
         """
 
         @wraps(func)
         def inner(self, *args, **kwargs):
+            canceled = 0
             while True:
                 try:
-                    yield from func(self, *args, **kwargs)
+                    for item in func(self, *args, **kwargs):
+                        canceled = 0
+                        yield item
                     break
+                except QueryCanceled as error:
+                    canceled += 1
+                    if canceled > self.governor.config.cancel_retries:
+                        raise
+                    self._retry_canceled(error, canceled)
                 except (OperationalError, InterfaceError) as r:
                     log.info(f"Postgres connect ERROR {r}")
-                    self.connect()
+                    if self.dsl is self.replica_dsl:
+                        # реплика недоступна: цикл продолжается
+                        # из primary, дата старта им уже покрыта
+                        self._switch(self.primary_dsl)
+                    else:
+                        self.connect()
 
         return inner
 
+    def _retry_canceled(self, error: QueryCanceled, retry: int) -> None:
+        """
+        Подготовка к повтору отмененного запроса: откат транзакции,
+        уменьшение пачки до конца цикла и пауза
+        по формуле backoff (boff_config).
+        :param error: ошибка отмены
+        :param retry: номер повтора
+        """
+        self.connection.rollback()
+        self.batch_size = max(1, self.batch_size // 2)
+        pause = min(
+            boff_config.start_sleep_time * boff_config.factor ** retry,
+            boff_config.border_sleep_time,
+        )
+        log.info(
+            f"Postgres query canceled {error}, retry {retry}"
+            f" batch {self.batch_size} sleep {pause}"
+        )
+        sleep(pause)
+
     @staticmethod
     def chunk_decor(func: Callable) -> Callable:
         """
         Функция чанкизирует данные генераторов
-        и отдает лист объектов для записи
-        при успехе устанавливает в стейт последий UUID
-        отданной пачки в соответсвующую таблицу
+        и отдает лист объектов для записи вместе с номером пачки.
+        Последний UUID пачки регистрируется в self.checkpoints
+        и попадает в стейт соответсвующей таблицы только после
+        подтверждения пачки и всех пачек, выданных до нее.
         :param func: функция генератор
-        :return: лист объектов для записи
+        :return: индекс, лист объектов для записи, номер пачки
         """
 
         @wraps(func)
         def inner(self, *args, **kwargs):
+            parent = kwargs.pop("parent", None)
             chunk_items = chunked(func(self, *args, **kwargs), self.batch_size)
             for items in chunk_items:
-                yield kwargs["index"], items
                 try:
                     last_uuid = items[-1]["id"]
                 except TypeError:
                     last_uuid = items[-1]
-                self.state.set_state(
-                    f"{kwargs['table']}_{kwargs['index']}_last_uuid",
-                    str(last_uuid)
+                seq = self.checkpoints.begin(
+                    self._uuid_key(kwargs["table"], kwargs["index"]),
+                    str(last_uuid),
+                    parent=parent,
                 )
+                yield kwargs["index"], items, seq
 
         return inner
 
-    @_reconnect
-    @chunk_decor
-    def extractor_films(
-        self, table: str, index: str, last_uuid=None
-    ) -> Iterable[dict[str, Any]]:
+    def _document_pages(
+        self, lower: datetime, upper: datetime, last_uuid=None
+    ) -> Iterable[list[dict[str, Any]]]:
         """
-        Функция генератор для получения фильмов.
-        Выборка ограничена датой старта, датой последней проверки,
-        лимитом, последним uuid
-        :return: возвращает данные фильма в виде словаря
+        Функция генератор страниц документов пайплайна,
+        измененных в промежутке (lower, upper], начиная после last_uuid.
+        :param lower: нижняя граница modified
+        :param upper: верхняя граница modified
+        :param last_uuid: последний uuid из прошлой выборки
+        :return: страница документов размером не больше batch_size
         """
         while True:
-            with self.connection.cursor() as curs:
-                if last_uuid is None:
-                    last_uuid = self.state.get_state(
-                        f"{table}_{index}_last_uuid"
-                    )
-                data = [self.last_modified, self.start_time]
-                query = get_query(table, last_uuid=last_uuid)
+            with self._cursor() as curs:
+                data = [lower, upper]
+                data += self._partition_params()
+                query = get_query(
+                    self.pipeline,
+                    last_uuid=last_uuid,
+                    partition=self.partition,
+                    light=self.dimensions is not None,
+                )
                 if last_uuid is not None:
                     data.append(last_uuid)
                 data.append(self.batch_size)
-                curs.execute(query, data)
+                self.governor.execute(curs, "documents", query, data)
                 if not curs.rowcount:
                     break
-                for row in curs.fetchall():
-                    yield Transform(row, index).transform()
-                last_uuid = row["id"]
+                transform = self._transformer(curs)
+                rows = curs.fetchall()
+                self.governor.rows(len(rows))
+                last_uuid = rows[-1][self._id_position(curs)]
+                yield [transform(row) for row in self._assemble(rows)]
 
     @_reconnect
     @chunk_decor
-    def extractor_single_table(
+    def extractor_documents(
         self, table: str, index: str, last_uuid=None
     ) -> Iterable[dict[str, Any]]:
         """
-        Функция генератор для получения данных таблиц без зависимых связей.
+        Функция генератор для получения документов пайплайна.
         Выборка ограничена датой старта, датой последней проверки,
         лимитом, последним uuid
-        :return: возвращает данные в виде словаря
+        :return: возвращает данные документа в виде словаря
         """
-        while True:
-            with self.connection.cursor() as curs:
-                if last_uuid is None:
-                    last_uuid = self.state.get_state(
-                        f"{table}_{index}_last_uuid"
-                    )
-                data = [self.last_modified, self.start_time]
-                query = get_query_single(table=table, last_uuid=last_uuid)
-                if last_uuid is not None:
-                    data.append(last_uuid)
-                data.append(self.batch_size)
-                curs.execute(query, data)
-                if not curs.rowcount:
-                    break
-                for row in curs.fetchall():
-                    yield Transform(row, index).transform()
-                last_uuid = row["id"]
+        if last_uuid is None:
+            last_uuid = self.state.get_state(self._uuid_key(table, index))
+        for page in self._document_pages(
+                self.last_modified, self.start_time, last_uuid
+        ):
+            yield from page
 
     @_reconnect
-    def _extractor_films_in(
-        self, index: str, in_films: list[str]
+    def _priority_documents(
+        self,
+    ) -> Iterable[tuple[str, list[dict[str, Any]], None]]:
+        """
+        Приоритетная полоса: документы таблицы пайплайна,
+        измененные после старта цикла (или прошлой проверки полосы).
+        Проверка выполняется не чаще раза в priority_latency секунд.
+        Перед проверкой кеш справочников обновляется.
+        Пачки не фиксируются в стейте: следующий цикл
+        все равно выберет эти документы, повторная загрузка
+        с той же внешней версией ничего не меняет.
+        :return: индекс, список объектов для записи, None вместо номера
+        """
+        if not self.priority_latency:
+            return
+        if perf_counter() - self._priority_polled < self.priority_latency:
+            return
+        if self.dimensions is not None:
+            # кеш обновлен в начале цикла: без обновления документ
+            # получит старое имя персоны с новой версией фильма,
+            # и каскад с той же версией уже не исправит его (409)
+            self.dimensions.stale = True
+        upper = datetime.now(timezone.utc)
+        for page in self._document_pages(self._priority_modified, upper):
+            log.info(f"Priority {self.pipeline.name} {len(page)} document")
+            yield self.pipeline.index, page, None
+        self._priority_modified = upper
+        self._priority_polled = perf_counter()
+
+    def _background(self, iterable: Iterable) -> Iterable:
+        """
+        Фоновая полоса: после каждой пачки каскада
+        выполняется приоритетная полоса. Каскад продолжается
+        со следующей пачки, прогресс фиксируется в стейте как обычно.
+        :param iterable: генератор пачек каскада
+        :return: пачки каскада и приоритетной полосы
+        """
+        for item in iterable:
+            yield item
+            yield from self._phase("priority", self._priority_documents())
+
+    @_reconnect
+    @chunk_decor
+    def extractor_copy(
+        self, table: str, index: str, last_uuid=None
     ) -> Iterable[dict[str, Any]]:
         """
-        Функция генератор для получения фильмов.
-        Выборка ограничена списком uuid фильмов
-        :param in_films: список запрашиваемых фильмов
-        :return: возвращает данные фильма в виде словаря
+        Функция генератор для первичной выгрузки документов через COPY.
+        Все документы выбираются одним запросом и разбираются
+        по мере поступления, без постраничных запросов.
+        Выборка ограничена датой старта, датой последней проверки,
+        последним uuid
+        :return: возвращает данные документа в виде словаря
         """
+        if last_uuid is None:
+            last_uuid = self.state.get_state(self._uuid_key(table, index))
+        data = [self.last_modified, self.start_time]
+        data += self._partition_params()
+        if last_uuid is not None:
+            data.append(last_uuid)
         with self.connection.cursor() as curs:
-            query = get_query("film_work", where_in=in_films)
-            curs.execute(query, in_films)
-            yield index, (
-                Transform(row, "movies").transform() for row in curs.fetchall()
+            query = curs.mogrify(
+                get_query_copy(
+                    self.pipeline,
+                    last_uuid=last_uuid,
+                    partition=self.partition,
+                    light=self.dimensions is not None,
+                ),
+                data
+            ).decode()
+        self.governor.prepare(self.connection, "copy")
+        stream = CopyStream(self.connection, query)
+        for rows in chunked(stream, self.batch_size):
+            self.governor.rows(len(rows))
+            for row in self._assemble(rows):
+                yield Transform(row, self.pipeline.model).transform()
+
+    @_reconnect
+    def _extractor_documents_in(
+        self, index: str, in_ids: list[str], seq: int = None
+    ) -> Iterable[dict[str, Any]]:
+        """
+        Функция генератор для получения документов пайплайна.
+        Выборка ограничена списком uuid
+        :param in_ids: список запрашиваемых документов
+        :param seq: номер пачки uuid, подтверждаемой вместе с документами
+        :return: возвращает данные документа в виде словаря
+        """
+        with self._cursor() as curs:
+            query = get_query(
+                self.pipeline,
+                where_in=in_ids,
+                limit=False,
+                light=self.dimensions is not None,
             )
+            self.governor.execute(curs, "documents", query, in_ids)
+            transform = self._transformer(curs)
+            rows = curs.fetchall()
+            self.governor.rows(len(rows))
+            rows = self._assemble(rows)
+            yield index, [transform(row) for row in rows], seq
+
+    def documents_in(self, ids: list[str]) -> list[dict[str, Any]]:
+        """
+        Функция получения документов пайплайна по списку uuid.
+        :param ids: список запрашиваемых документов
+        :return: список объектов для записи
+        """
+        for _, items, _ in self._extractor_documents_in(
+                index=self.pipeline.index,
+                in_ids=ids
+        ):
+            return items
+        return []
+
+    def reconcile_ids(
+        self, with_version: bool
+    ) -> Iterable[tuple[str, Optional[int]]]:
+        """
+        Функция генератор всех uuid документов пайплайна,
+        отсортированных по uuid, для сверки с индексом.
+        Используется серверный курсор, память не зависит от размера таблицы.
+        Курсор открыт на отдельном подключении: откат основного
+        (documents_in во время сверки) не закроет его.
+        :param with_version: отдавать также версию документа
+        :return: uuid и версия документа
+        """
+        with closing(psycopg2.connect(**self.dsl)) as connection:
+            with connection.cursor(
+                    name=f"reconcile_{self.pipeline.name}",
+                    cursor_factory=_cursor
+            ) as curs:
+                curs.itersize = self.batch_size
+                self.governor.prepare(connection, "ids")
+                curs.execute(
+                    get_query_reconcile(self.pipeline, with_version)
+                )
+                for row in curs:
+                    self.governor.rows(1)
+                    yield str(row[0]), row[1] if with_version else None
 
     @_reconnect
     @chunk_decor
     def _extractor_ids(
-        self, table: str, index: str, last_uuid: str = None, where_in=None
+        self,
+        table: str,
+        index: str,
+        last_uuid: str = None,
+        reference: ReferenceConfig = None,
+        where_in=None,
+        resume: bool = True,
     ) -> Iterable[list[str]]:
         """
         Функция генератор для получения списка uuid данной таблицы.
         Выборка выборка может быть ограничена 2 спосбомаи:
         1.  Ограничена датой старта, датой последней проверки,
             лимитом, последним uuid.
-        2.  Списком uuid, последним uuid, лимитом
+        2.  Списком uuid reference таблицы через таблицу М2М,
+            последним uuid, лимитом
         :param table: название таблицы
+        :param reference: описание reference таблицы для выборки из М2М
         :param where_in: список uuid
+        :param resume: продолжить выборку с последнего uuid из стейта
         :return: список uuid
         """
         while True:
             with self.connection.cursor() as curs:
-                if last_uuid is None:
+                if last_uuid is None and resume:
                     last_uuid = self.state.get_state(
-                        f"{table}_{index}_last_uuid"
+                        self._uuid_key(table, index)
                     )
                 if where_in is None:
                     data = [self.last_modified, self.start_time]
+                    query = get_query_ids(table=table, last_uuid=last_uuid)
                 else:
                     data = [i for i in where_in]
-                query = get_query(
-                    table=table,
-                    last_uuid=last_uuid,
-                    where_in=data
-                )
+                    query = get_query_m2m(
+                        reference=reference,
+                        where_in=data,
+                        last_uuid=last_uuid,
+                        partition=self.partition
+                    )
+                    data += self._partition_params()
                 if last_uuid is not None:
                     data.append(last_uuid)
                 data.append(self.batch_size)
-                curs.execute(query, data)
+                self.governor.execute(curs, "ids", query, data)
                 if not curs.rowcount:
                     break
-                for row in curs.fetchall():
+                rows = curs.fetchall()
+                self.governor.rows(len(rows))
+                for row in rows:
                     yield row["id"]
                 last_uuid = row["id"]
 
     def _reference_extractor(
         self,
-        reference_tab: str,
+        reference: ReferenceConfig,
         index: str,
     ) -> Iterable[dict[str, Any]]:
         """
-        Функция генератор для получения изменений фильмов через 3 запроса
+        Функция генератор для получения изменений документов через 3 запроса
         Сначала происходит выборка изменений в reference таблице,
-        Далее собирается список свзаных фильмов через таблицу М2М
-        Собираются все фильмы входящие в выборку из прошлого запроса
-        :param reference_tab: таблица genre или person
+        Далее собирается список свзаных документов через таблицу М2М
+        Собираются все документы входящие в выборку из прошлого запроса
+        :param reference: описание reference таблицы
         :return: возвращает список объектов для записи
         """
-        for _, reference_ids in self._extractor_ids(
-                table=reference_tab,
+        resume = True
+        for _, reference_ids, reference_seq in self._extractor_ids(
+                table=reference.table,
                 index=index
         ):
-            for _, film_work_ids in self._extractor_ids(
-                table=f"{reference_tab}_film_work",
+            if resume:
+                # сохраненный uuid М2М относится к первой пачке reference
+                self.checkpoints.attach(
+                    self._uuid_key(reference.m2m_table, index), reference_seq
+                )
+            for _, ids, seq in self._extractor_ids(
+                table=reference.m2m_table,
                     index=index,
-                    where_in=reference_ids
+                    reference=reference,
+                    where_in=reference_ids,
+                    resume=resume,
+                    parent=reference_seq,
             ):
-                yield from self._extractor_films_in(
+                yield from self._extractor_documents_in(
                     index=index,
-                    in_films=film_work_ids
+                    in_ids=ids,
+                    seq=seq,
                 )
-            self.state.set_state(
-                f"{reference_tab}_film_work_{index}_last_uuid",
-                None
-            )
-            log.info(f"Del reference UUID from {reference_tab}_film_work")
+            self.checkpoints.ack(reference_seq)
+            resume = False
+
+    def _phase(self, name: str, iterable: Iterable) -> Iterable:
+        """
+        Учитывает в self.phases время получения элементов генератора
+        (выборка и трансформация), без времени загрузки пачек.
+        :param name: название фазы
+        :param iterable: генератор фазы
+        :return: элементы генератора
+        """
+        started = perf_counter()
+        for item in iterable:
+            self.phases[name] += perf_counter() - started
+            yield item
+            started = perf_counter()
+        self.phases[name] += perf_counter() - started
+
+    def _state_key(self, key: str) -> str:
+        return f"{self.pipeline.name}{self.key_suffix}_{key}"
+
+    def _uuid_key(self, table: str, index: str) -> str:
+        return f"{table}_{index}{self.key_suffix}_last_uuid"
+
+    def _partition_params(self) -> list[str]:
+        return self.partition.params if self.partition is not None else []
 
     def extractors(self) -> Iterable[tuple[str, list[dict[str, Any]]]]:
         """
-        Функция композитного генератора для получения изменения фильмов.
-        В начале итерации создается ограничение в виде временного отрезка.
+        Функция композитного генератора для получения изменения документов
+        пайплайна. В начале итерации создается ограничение
+        в виде временного отрезка.
         Проверка происходит:
 
             1. От даты старой проверки (если такая имеется)
@@ -245,52 +621,105 @@ class PostgresExtractor:
 
         При успешном прохождении всех проверок,
         последняя дата проверки назначается датой старта.
-        :return:возвращает индекс и список объектов для записи
+        Если задана реплика, цикл выбирает данные из нее, а дата старта
+        ограничена временем, до которого реплика применила изменения.
+        Каждая пачка подтверждается через self.checkpoints.ack(seq)
+        после загрузки, окончание цикла фиксируется после
+        подтверждения всех пачек.
+        :return:возвращает индекс, список объектов для записи, номер пачки
         """
-        self.last_modified = self.state.get_state("last_modified")
-        if self.last_modified is None:
+        pipeline = self.pipeline
+        replica_time = self._route()
+        self.last_modified = self.state.get_state(
+            self._state_key("last_modified")
+        )
+        if self.last_modified is None and self.partition is None:
+            # состояние до разделения на пайплайны,
+            # частям оно переносится при включении координации
+            self.last_modified = self.state.get_state("last_modified")
+        initial = self.last_modified is None
+        if initial:
             self.last_modified = datetime(1, 1, 1, tzinfo=timezone.utc)
-        self.start_time = self.state.get_state("start_time")
+        self.batch_size = self.default_batch_size
+        self.start_time = self.state.get_state(self._state_key("start_time"))
+        cycle_start = None
+        if self.cycle is not None:
+            # дату старта согласуют все пайплайны цикла,
+            # в том числе продолжающие незаконченный цикл
+            cycle_start = self.cycle.start_time(
+                replica_time or datetime.now(timezone.utc)
+            )
         if self.start_time is None:
-            self.start_time = datetime.now(timezone.utc)
-            self.state.set_state("start_time", str(self.start_time))
+            self.start_time = (
+                cycle_start or replica_time or datetime.now(timezone.utc)
+            )
+            self.state.set_state(
+                self._state_key("start_time"),
+                str(self.start_time)
+            )
+        start_time = datetime.fromisoformat(str(self.start_time))
+        if replica_time is not None and replica_time < start_time:
+            log.info("Replica is behind start_time, use primary")
+            self._switch(self.primary_dsl)
         batch_state = {
-            "start_time": None,
-            "last_modified": str(self.start_time),
-            "film_work_movies_last_uuid": None,
-            "genre_movies_last_uuid": None,
-            "genre_film_work_movies_last_uuid": None,
-            "person_movies_last_uuid": None,
-            "person_film_work_movies_last_uuid": None,
-            "person_persons_last_uuid": None,
-            "genre_genres_last_uuid": None,
+            self._state_key("start_time"): None,
+            self._state_key("last_modified"): str(self.start_time),
+            self._uuid_key(pipeline.table, pipeline.index): None,
         }
-        log.info("Start check films")
-        yield from self.extractor_films(table="film_work", index="movies")
-        log.info("End check films")
-        log.info("Start check persons")
-        yield from self.extractor_single_table(table="person", index="persons")
-        log.info("End check persons")
-        log.info("Start check genres")
-        yield from self.extractor_single_table(table="genre", index="genres")
-        log.info("End check genres")
-        if self.state.get_state("last_modified") is None:
-            log.info("Last_modified is None,set last_modified")
-            self.state.butch_set_state(batch_state)
+        for reference in pipeline.references:
+            batch_state[self._uuid_key(reference.table, pipeline.index)] = None
+            batch_state[
+                self._uuid_key(reference.m2m_table, pipeline.index)
+            ] = None
+        self.phases.clear()
+        if self.dimensions is not None:
+            self.dimensions.stale = True
+        log.info(f"Start check {pipeline.name}")
+        if self.copy_initial and initial:
+            log.info("Last_modified is None, initial load through COPY")
+            yield from self._phase("copy", self.extractor_copy(
+                table=pipeline.table,
+                index=pipeline.index
+            ))
+        else:
+            yield from self._phase("documents", self.extractor_documents(
+                table=pipeline.table,
+                index=pipeline.index
+            ))
+        log.info(f"End check {pipeline.name}")
+        self._priority_modified = self.start_time
+        self._priority_polled = perf_counter()
+        if initial:
+            self.checkpoints.on_drain(
+                lambda: self._commit_cycle(batch_state)
+            )
             return
-        log.info("Start check modified genre for film")
-        yield from self._reference_extractor(
-            reference_tab="genre",
-            index="movies"
-        )
-        log.info("End check modified genre for film")
-        log.info("Start check modified person for film")
-        yield from self._reference_extractor(
-            reference_tab="person",
-            index="movies"
-        )
-        log.info("End check modified person for film")
-        log.info("Set Last_modified")
+        for reference in pipeline.references:
+            log.info(f"Start check modified {reference.table}"
+                     f" for {pipeline.name}")
+            yield from self._background(self._phase(
+                f"reference {reference.table}",
+                self._reference_extractor(
+                    reference=reference,
+                    index=pipeline.index
+                )
+            ))
+            log.info(f"End check modified {reference.table}"
+                     f" for {pipeline.name}")
+        self.checkpoints.on_drain(lambda: self._commit_cycle(batch_state))
+
+    def _commit_cycle(self, batch_state: dict[str, Any]) -> None:
+        """
+        Фиксирует окончание цикла, когда все выданные пачки подтверждены.
+        В общем цикле пайплайнов состояния передаются в SyncCycle
+        и сохраняются, когда цикл закончат все пайплайны.
+        :param batch_state: состояния окончания цикла
+        """
+        if self.cycle is not None:
+            log.info(f"End cycle {self.pipeline.name}")
+            self.cycle.defer(batch_state)
+            return
+        log.info(f"Set Last_modified {self.pipeline.name}")
         self.state.butch_set_state(batch_state)
 
     def __enter__(self):
@@ -308,5 +737,5 @@ class PostgresExtractor:
         :param exc_val:
         :param exc_tb:
         """
-        self.connection.close()
+        self._close()
         log.info("Postgres connection close")
@@ -0,0 +1,196 @@
+import logging
+from datetime import datetime
+from time import monotonic, perf_counter, sleep
+from typing import Any, Optional
+
+from psycopg2.errors import QueryCanceled
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extensions import connection as _connection
+from psycopg2.extensions import cursor as _cursor
+
+from postgres_to_es.tools.config import GovernorConfig
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Ограничение скорости: rate токенов в секунду,
+    не больше rate токенов накопленного запаса.
+    Запрос больше запаса уходит в долг, следующий запрос
+    ждет, пока долг не будет погашен.
+    rate = 0 - без ограничения.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = monotonic()
+
+    def take(self, count: float) -> None:
+        """
+        Забирает count токенов, при нехватке ожидает.
+        :param count: количество токенов
+        """
+        if not self.rate:
+            return
+        now = monotonic()
+        self.tokens = min(
+            self.rate, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        self.tokens -= count
+        if self.tokens < 0:
+            sleep(-self.tokens / self.rate)
+
+
+class Governor:
+    """
+    Ограничение нагрузки Extractor на Postgres.
+    Запросы и строки ограничиваются TokenBucket,
+    перед запросом на подключении выставляются statement_timeout
+    и work_mem его класса (documents, ids, copy).
+    Если задан latency_target и запрос выполнялся дольше,
+    коэффициент замедления удваивается (до max_slowdown), иначе
+    уменьшается. После запроса выполняется пауза
+    (slowdown - 1) * время запроса, то есть база занята
+    не больше 1 / slowdown времени.
+    """
+
+    def __init__(self, config: GovernorConfig):
+        self.config = config
+        self.queries = TokenBucket(config.queries_per_sec)
+        self.rows_bucket = TokenBucket(config.rows_per_sec)
+        self.slowdown = 1.0
+        self._applied: dict[str, str] = {}
+        self._applied_connection: Optional[_connection] = None
+
+    def prepare(self, connection: _connection, kind: str) -> None:
+        """
+        Учитывает запрос и выставляет настройки его класса.
+        :param connection: подключение, на котором выполнится запрос
+        :param kind: класс запроса
+        """
+        self.queries.take(1)
+        # вне транзакции: настройки незафиксированной транзакции
+        # могли быть отменены откатом
+        if (
+            connection is not self._applied_connection
+            or connection.info.transaction_status == TRANSACTION_STATUS_IDLE
+        ):
+            self._applied = {}
+            self._applied_connection = connection
+        settings = {
+            "statement_timeout": self.config.statement_timeout.get(kind, "0"),
+            "work_mem": self.config.work_mem.get(kind, "DEFAULT"),
+        }
+        changed = {
+            name: value for name, value in settings.items()
+            if self._applied.get(name) != value
+        }
+        if not changed:
+            return
+        with connection.cursor() as curs:
+            for name, value in changed.items():
+                if value == "DEFAULT":
+                    curs.execute(f"SET {name} TO DEFAULT")
+                else:
+                    curs.execute(
+                        "SELECT set_config(%s, %s, false)", (name, value)
+                    )
+        self._applied.update(changed)
+
+    def execute(
+        self, curs: _cursor, kind: str, query: str, params: Any = None
+    ) -> None:
+        """
+        Выполняет запрос с ограничениями класса kind
+        и подстраивает замедление по времени выполнения.
+        :param curs: курсор
+        :param kind: класс запроса
+        :param query: запрос
+        :param params: параметры запроса
+        """
+        self.prepare(curs.connection, kind)
+        started = perf_counter()
+        try:
+            curs.execute(query, params)
+        except QueryCanceled:
+            self._slow_down()
+            raise
+        self._adapt(perf_counter() - started)
+
+    def rows(self, count: int) -> None:
+        """
+        Учитывает полученные строки.
+        :param count: количество строк
+        """
+        self.rows_bucket.take(count)
+
+    @staticmethod
+    def wal_position(connection: _connection) -> tuple[str, datetime]:
+        """
+        Текущая позиция журнала primary.
+        Время берется через clock_timestamp(): подключение extractor
+        не завершает транзакцию, и now() на нем остается временем
+        ее начала.
+        :param connection: подключение к primary
+        :return: LSN и время primary, изменения, зафиксированные
+            до этого времени, записаны в журнал до LSN
+        """
+        with connection.cursor() as curs:
+            curs.execute(
+                "SELECT pg_current_wal_lsn()::text, clock_timestamp()"
+            )
+            lsn, now = curs.fetchone()
+        return lsn, now
+
+    def replica_time(
+        self, connection: _connection, position: tuple[str, datetime]
+    ) -> Optional[datetime]:
+        """
+        Время, до которого реплика применила изменения primary.
+        Если реплика применила журнал до позиции primary,
+        отставания нет: на простаивающем primary время последней
+        примененной транзакции не меняется, но реплика актуальна.
+        Время реплики - clock_timestamp(), как в wal_position.
+        :param connection: подключение к реплике
+        :param position: позиция журнала primary (wal_position)
+        :return: время или None, если отставание больше max_replica_lag
+        """
+        lsn, primary_now = position
+        with connection.cursor() as curs:
+            curs.execute(
+                "SELECT pg_is_in_recovery(),"
+                " pg_last_wal_replay_lsn() >= %s::pg_lsn,"
+                " pg_last_xact_replay_timestamp(), clock_timestamp()",
+                [lsn]
+            )
+            in_recovery, caught_up, replayed, now = curs.fetchone()
+        if not in_recovery:
+            return now
+        if caught_up:
+            return primary_now
+        if replayed is None:
+            return None
+        lag = (now - replayed).total_seconds()
+        if lag > self.config.max_replica_lag:
+            log.info(f"Replica lag {lag:.1f} sek, use primary")
+            return None
+        return replayed
+
+    def _slow_down(self) -> None:
+        slowdown = min(self.slowdown * 2, self.config.max_slowdown)
+        if slowdown != self.slowdown:
+            log.info(f"Postgres slow, slowdown x{slowdown:g}")
+        self.slowdown = slowdown
+
+    def _adapt(self, elapsed: float) -> None:
+        if not self.config.latency_target:
+            return
+        if elapsed > self.config.latency_target:
+            self._slow_down()
+        else:
+            self.slowdown = max(1.0, self.slowdown * 0.75)
+        if self.slowdown > 1:
+            sleep(elapsed * (self.slowdown - 1))
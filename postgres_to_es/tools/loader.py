@@ -2,20 +2,23 @@ import json
 import logging
 from functools import wraps
 from time import sleep
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Iterable, Optional
 
 from elasticsearch import BadRequestError, Elasticsearch, helpers
 from elasticsearch.helpers import BulkIndexError
 
 from postgres_to_es.tools.backoff import backoff, boff_config
-from postgres_to_es.tools.config import ES_SCHEME, ESConfig
+from postgres_to_es.tools.config import ES_SCHEME, ESConfig, PipelineConfig
 
 log = logging.getLogger(__name__)
 
+PIT_KEEP_ALIVE = "5m"
+
 
 class Loader:
-    def __init__(self, config: ESConfig):
+    def __init__(self, config: ESConfig, pipelines: list[PipelineConfig]):
         self.config = config
+        self.pipelines = pipelines
         self.connection: Optional[Elasticsearch] = None
 
     @backoff(**boff_config.dict())
@@ -53,15 +56,22 @@ class Loader:
         return inner
 
     @_reconnect
-    def bulk(self, data: list[dict[str, Any]], index: str) -> None:
+    def bulk(self, data: list[dict[str, Any]], index: str) -> list[str]:
         """
         Отправка данных в Elasticsearch.
+        Конфликт внешней версии (409) означает, что в индексе уже есть
+        такая же или более высокая версия документа, и ошибкой не считается.
+        Более высокая версия в индексе не всегда означает более новые данные:
+        версия фильма - максимум по его текущим персонам и жанрам
+        и уменьшается при удалении связи или персоны. Такие документы
+        возвращаются, чтобы перечитать их и записать через overwrite.
         Если возникнут ошибки при загрузке данных,
         повториться попытка загрузки через
         self.config.bulk_retrys_sleep секунд.
         При максимальном количестве попыток произойдет разрыв подклчения.
         :param index: индекс записи
         :param data: список объектов для загрузки
+        :return: uuid документов, версия которых в индексе выше
         """
         retry = 0
         while True:
@@ -71,6 +81,7 @@ class Loader:
                 actions=data,
                 raise_on_error=False
             )
+            errors, conflicts = self._skip_conflicts(errors, index)
             if len(errors) != 0:
                 log.info(
                     f"Elasticsearch dont save to {index}"
@@ -86,33 +97,194 @@ class Loader:
                     log.info("Elasticsearch connection close")
                     raise BulkIndexError
             log.info(f"Elasticsearch save in {index} {ok} document")
-            break
+            return self._lowered(data, conflicts, index)
+
+    def overwrite(self, data: list[dict[str, Any]], index: str) -> None:
+        """
+        Запись документов поверх версии индекса.
+        Документ записывается с версией max(версия индекса, своя версия)
+        и version_type=external_gte, поэтому заменяет документ
+        с той же версией. Данные должны быть прочитаны из Postgres
+        после записи документа в индексе.
+        :param data: список объектов для загрузки
+        :param index: индекс записи
+        """
+        versions = self._versions([item["_id"] for item in data], index)
+        for item in data:
+            current = versions.get(item["_id"])
+            if current is None or item.get("_version") is None:
+                continue
+            item["_version"] = max(current, item["_version"])
+            item["_version_type"] = "external_gte"
+        self.bulk(data, index)
+
+    def _lowered(
+        self, data: list[dict[str, Any]], conflicts: list[str], index: str
+    ) -> list[str]:
+        """
+        Документы с конфликтом версий, версия которых в индексе выше.
+        :param data: отправленные документы
+        :param conflicts: uuid документов с конфликтом версий
+        :param index: индекс записи
+        :return: uuid документов
+        """
+        if not conflicts:
+            return []
+        versions = self._versions(conflicts, index)
+        own = {item["_id"]: item.get("_version") for item in data}
+        return [
+            doc_id for doc_id in conflicts
+            if own.get(doc_id) is not None
+            and versions.get(doc_id, 0) > own[doc_id]
+        ]
+
+    @_reconnect
+    def _versions(self, ids: list[str], index: str) -> dict[str, int]:
+        """
+        Текущие версии документов индекса.
+        :param ids: uuid документов
+        :param index: индекс
+        :return: версии найденных документов
+        """
+        if not ids:
+            return {}
+        response = self.connection.mget(index=index, ids=ids, source=False)
+        return {
+            doc["_id"]: doc["_version"]
+            for doc in response["docs"] if doc.get("found")
+        }
+
+    def delete(
+        self, data: list[tuple[str, Optional[int]]], index: str
+    ) -> None:
+        """
+        Удаление документов из Elasticsearch.
+        Если известна версия документа, удаление выполняется
+        только если документ не обновлялся после ее получения.
+        Отсутствующий документ (404) и конфликт версий (409)
+        ошибкой не считаются. Остальные ошибки не повторяются:
+        BulkIndexError поднимается вне повтора подключения.
+        :param data: список uuid и версий документов
+        :param index: индекс записи
+        """
+        actions = []
+        for doc_id, version in data:
+            action = {"_op_type": "delete", "_id": doc_id}
+            if version is not None:
+                action["_version"] = version
+                action["_version_type"] = "external_gte"
+            actions.append(action)
+        ok, errors = self._bulk_actions(actions, index)
+        errors = [
+            error for error in errors
+            if next(iter(error.values())).get("status") not in (404, 409)
+        ]
+        if len(errors) != 0:
+            log.info(errors)
+            raise BulkIndexError(
+                f"Elasticsearch dont delete {len(errors)} document", errors
+            )
+        log.info(f"Elasticsearch delete from {index} {ok} document")
+
+    @_reconnect
+    def _bulk_actions(
+        self, actions: list[dict[str, Any]], index: str
+    ) -> tuple[int, list[dict]]:
+        """
+        Отправка действий в Elasticsearch без проверки ошибок.
+        :param actions: действия bulk
+        :param index: индекс
+        :return: количество успешных действий и ошибки
+        """
+        return helpers.bulk(
+            self.connection,
+            index=index,
+            actions=actions,
+            raise_on_error=False
+        )
+
+    @_reconnect
+    def open_point_in_time(self, index: str) -> str:
+        """
+        Открывает point in time для согласованного чтения индекса.
+        :param index: индекс
+        :return: id point in time
+        """
+        return self.connection.open_point_in_time(
+            index=index,
+            keep_alive=PIT_KEEP_ALIVE
+        )["id"]
+
+    def iter_ids(
+        self, pit_id: str, size: int
+    ) -> Iterable[tuple[str, Optional[int]]]:
+        """
+        Функция генератор всех uuid документов индекса,
+        отсортированных по id, через point in time и search_after.
+        По окончании point in time закрывается.
+        :param pit_id: id point in time
+        :param size: размер страницы
+        :return: uuid и версия документа
+        """
+        search_after = None
+        try:
+            while True:
+                response = self.connection.search(
+                    pit={"id": pit_id, "keep_alive": PIT_KEEP_ALIVE},
+                    sort=[{"id": "asc"}],
+                    search_after=search_after,
+                    size=size,
+                    source=False,
+                    version=True,
+                    track_total_hits=False,
+                )
+                pit_id = response.get("pit_id", pit_id)
+                hits = response["hits"]["hits"]
+                if not hits:
+                    break
+                for hit in hits:
+                    yield hit["_id"], hit.get("_version")
+                search_after = hits[-1]["sort"]
+        finally:
+            self.connection.close_point_in_time(id=pit_id)
+
+    @staticmethod
+    def _skip_conflicts(
+        errors: list[dict], index: str
+    ) -> tuple[list[dict], list[str]]:
+        """
+        Отбрасывает ошибки конфликта версий.
+        :param errors: ошибки helpers.bulk
+        :param index: индекс записи
+        :return: остальные ошибки и uuid документов с конфликтом
+        """
+        other, conflicts = [], []
+        for error in errors:
+            item = next(iter(error.values()))
+            if item.get("status") == 409:
+                conflicts.append(item["_id"])
+            else:
+                other.append(error)
+        if conflicts:
+            log.info(
+                f"Elasticsearch skip {len(conflicts)}"
+                f" stale document in {index}"
+            )
+        return other, conflicts
 
     @_reconnect
     def create_indexes(self):
+        """
+        Создает индексы пайплайнов, если их еще нет.
+        """
         with open(ES_SCHEME) as j:
             es_shema = json.load(j)
+        for pipeline in self.pipelines:
             try:
                 self.connection.indices.create(
                     settings=es_shema["settings"],
-                    mappings=es_shema["mappings_movies"],
-                    index="movies",
-                )
-            except BadRequestError:
-                pass
-            try:
-                self.connection.indices.create(
-                    settings=es_shema["settings"],
-                    mappings=es_shema["mappings_persons"],
-                    index="persons",
-                )
-            except BadRequestError:
-                pass
-            try:
-                self.connection.indices.create(
-                    settings=es_shema["settings"],
-                    mappings=es_shema["mappings_genres"],
-                    index="genres",
+                    mappings=es_shema[pipeline.mapping],
+                    index=pipeline.index,
                 )
             except BadRequestError:
                 pass
@@ -120,7 +292,7 @@ class Loader:
     def __enter__(self):
         """
         Иницирует подклчение Elasticsearch.
-        Пытается создать индекс.
+        Пытается создать индексы пайплайнов.
         :return: self
         """
         self._connect()
@@ -1,110 +1,181 @@
-def get_query(table: str, last_uuid: str = None, where_in: list = None) -> str:
+from postgres_to_es.tools.config import (
+    Partition,
+    PipelineConfig,
+    ReferenceConfig,
+)
+
+
+def _placeholders(values: list) -> str:
+    return f"({', '.join('%s' for _ in values)})"
+
+
+def _partition_where(column: str, partition: Partition = None) -> str:
+    """
+    Условие диапазона uuid части пайплайна,
+    параметры - partition.params
+    """
+    if partition is None:
+        return ""
+    where = f" AND {column} >= %s"
+    if partition.upper is not None:
+        where += f" AND {column} < %s"
+    return where
+
+
+def get_version_column(modified_column: str) -> str:
+    """
+    Колонка внешней версии документа:
+    время модификации в микросекундах.
+    :param modified_column: колонка времени модификации
+    :return:
     """
-    Функция создания query в зависимоти от параметров.
+    return (
+        f"(EXTRACT(EPOCH FROM {modified_column}) * 1000000)::bigint"
+        " as version"
+    )
+
+
+def get_query(
+    pipeline: PipelineConfig,
+    last_uuid: str = None,
+    where_in: list = None,
+    limit: bool = True,
+    partition: Partition = None,
+    light: bool = False,
+) -> str:
+    """
+    Функция создания query документов пайплайна в зависимоти от параметров.
+    Запрос берется из SQL шаблона пайплайна
+    или собирается из таблицы и колонок.
     Все запросы сортируются по uuid
-    :param table: название таблицы сбора данных
+    :param pipeline: описание пайплайна
     :param last_uuid: последний uuid из прошлой выборки для ограничения
     :param where_in: список id данные которых необходимо получить
+    :param limit: ограничить выборку размером пачки
+    :param partition: ограничить выборку диапазоном uuid
+    :param light: использовать облегченный шаблон light_query
     :return:
     """
-    query = ""
-    if table == "genre" or table == "person":
-        query = f"""
-        SELECT id, modified
-        FROM content.{table}
-        WHERE modified > %s AND modified <= %s"""
+    id_column = pipeline.id_column
+    modified_column = pipeline.modified_column
+    if where_in is not None:
+        where = f"{id_column} IN {_placeholders(where_in)}"
+    else:
+        where = f"{modified_column} > %s AND {modified_column} <= %s"
+        where += _partition_where(id_column, partition)
         if last_uuid is not None:
-            query += " AND id > %s"
-        query += " ORDER BY id LIMIT %s;"
-    if table == "genre_film_work" or table == "person_film_work":
-        query = f"""SELECT DISTINCT fw.id as id
-                FROM content.film_work fw
-                    LEFT JOIN content.{table} rfw ON rfw.film_work_id = fw.id
-                WHERE"""
-        if where_in is not None:
-            ref_id = "genre_id" if table == "genre_film_work" else "person_id"
-            query += f" rfw.{ref_id} IN "
-            query += f"({', '.join('%s' for _ in where_in)})"
-        if last_uuid is not None:
-            query += " AND fw.id > %s"
-        query += " ORDER BY fw.id LIMIT %s;"
-    if table == "film_work":
-        query = """
-        SELECT
-            fw.id,
-            fw.title,
-            fw.description,
-            fw.rating,
-            fw.type,
-            fw.created,
-            fw.modified as modified,
-            COALESCE (
-               json_agg(
-                   DISTINCT jsonb_build_object(
-                       'person_role', pfw.role,
-                       'person_id', p.id,
-                       'person_name', p.full_name
-                   )
-               ) FILTER (WHERE p.id is not null),
-               '[]'
-            ) as persons,
-            COALESCE (
-               json_agg(
-                   DISTINCT jsonb_build_object(
-                       'genre_name', g.name,
-                       'genre_id', g.id
-                   )
-               ) FILTER (WHERE g.id is not null),
-               '[]'
-            ) as genres
-        FROM content.film_work fw
-            LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-            LEFT JOIN content.person p ON p.id = pfw.person_id
-            LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-            LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE"""
-        if where_in is not None:
-            query += " fw.id IN "
-            query += f"({', '.join('%s' for _ in where_in)})"
-            query += " GROUP BY fw.id"
-        else:
-            query += " fw.modified > %s AND fw.modified <= %s"
-            if last_uuid is not None:
-                query += " AND fw.id > %s"
-            query += " GROUP BY fw.id ORDER BY fw.id LIMIT %s"
+            where += f" AND {id_column} > %s"
+    template = pipeline.light_query if light else pipeline.query
+    if template is not None:
+        query = template.strip().replace("{where}", where)
+    else:
+        columns = list(pipeline.columns)
+        if pipeline.versioned:
+            columns.append(get_version_column(modified_column))
+        query = f"""
+        SELECT {', '.join(columns)}
+        FROM content.{pipeline.table}
+        WHERE {where}"""
+    query += f" ORDER BY {id_column}"
+    if limit:
+        query += " LIMIT %s"
     return query
 
 
-def get_query_single(table: str, last_uuid: str = None) -> str:
+def get_query_ids(table: str, last_uuid: str = None) -> str:
     """
-    Функция создания query запроса в таблицу без зависимостей.
+    Функция создания query списка измененных uuid таблицы.
     Все запросы сортируются по uuid
     :param table: название таблицы сбора данных
     :param last_uuid: последний uuid из прошлой выборки для ограничения
-    :param where_in: список id данные которых необходимо получить
     :return:
     """
-    query = ""
-    if table == "person":
-        query = """
-                SELECT
-                    sng.id,
-                    sng.full_name,
-                    sng.modified
-                FROM content.person sng
-                WHERE sng.modified > %s AND sng.modified <= %s"""
-        if last_uuid is not None:
-            query += " AND sng.id > %s"
-    elif table == "genre":
-        query = """
-                SELECT
-                    sng.id,
-                    sng.name,
-                    sng.description,
-                    sng.modified
-                FROM content.genre sng
-                WHERE sng.modified > %s AND sng.modified <= %s"""
-        if last_uuid is not None:
-            query += " AND sng.id > %s"
-    query += " ORDER BY sng.id LIMIT %s"
+    query = f"""
+    SELECT id, modified
+    FROM content.{table}
+    WHERE modified > %s AND modified <= %s"""
+    if last_uuid is not None:
+        query += " AND id > %s"
+    query += " ORDER BY id LIMIT %s;"
     return query
+
+
+def get_query_m2m(
+    reference: ReferenceConfig,
+    where_in: list,
+    last_uuid: str = None,
+    partition: Partition = None,
+) -> str:
+    """
+    Функция создания query списка uuid документов,
+    связанных с reference записями через таблицу М2М.
+    Все запросы сортируются по uuid
+    :param reference: описание reference таблицы
+    :param where_in: список uuid reference таблицы
+    :param last_uuid: последний uuid из прошлой выборки для ограничения
+    :param partition: ограничить выборку диапазоном uuid
+    :return:
+    """
+    target = f"rfw.{reference.m2m_target}"
+    query = f"""
+    SELECT DISTINCT {target} as id
+    FROM content.{reference.m2m_table} rfw
+    WHERE rfw.{reference.m2m_column} IN {_placeholders(where_in)}"""
+    query += _partition_where(target, partition)
+    if last_uuid is not None:
+        query += f" AND {target} > %s"
+    query += f" ORDER BY {target} LIMIT %s;"
+    return query
+
+
+def get_query_reconcile(pipeline: PipelineConfig, with_version: bool) -> str:
+    """
+    Функция создания query всех uuid документов пайплайна
+    для сверки с индексом. Все запросы сортируются по uuid
+    :param pipeline: описание пайплайна
+    :param with_version: выбрать также версию документа
+    :return:
+    """
+    if not with_version:
+        return f"SELECT id FROM content.{pipeline.table} ORDER BY id"
+    if pipeline.query is not None:
+        query = pipeline.query.strip().replace("{where}", "TRUE")
+        return (
+            f"SELECT docs.id, docs.version FROM ({query}) docs"
+            " ORDER BY docs.id"
+        )
+    return (
+        f"SELECT id, {get_version_column(pipeline.modified_column)}"
+        f" FROM content.{pipeline.table} ORDER BY id"
+    )
+
+
+def get_query_copy(
+    pipeline: PipelineConfig,
+    last_uuid: str = None,
+    partition: Partition = None,
+    light: bool = False,
+) -> str:
+    """
+    Функция создания запроса COPY для первичной выгрузки пайплайна.
+    Каждая строка результата - JSON документ,
+    сортировка по uuid позволяет продолжить выгрузку с места остановки.
+    Порядок подзапроса не гарантирует порядок внешней выборки,
+    поэтому сортировка повторяется снаружи.
+    :param pipeline: описание пайплайна
+    :param last_uuid: последний uuid из прошлой выборки для ограничения
+    :param partition: ограничить выборку диапазоном uuid
+    :param light: использовать облегченный шаблон light_query
+    :return:
+    """
+    query = get_query(
+        pipeline,
+        last_uuid=last_uuid,
+        limit=False,
+        partition=partition,
+        light=light,
+    )
+    return (
+        f"COPY (SELECT row_to_json(copy_row) FROM ({query}) copy_row"
+        " ORDER BY copy_row.id) TO STDOUT"
+    )
@@ -0,0 +1,190 @@
+import json
+import logging
+import mmap
+import os
+import zlib
+from threading import Lock
+from typing import IO, Any, Iterable, Optional
+
+from postgres_to_es.tools.checkpoint import CheckpointTracker
+from postgres_to_es.tools.state import State
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = "index.ndjson"
+REPLAY_STORAGE = "replay.json"
+
+
+def _segment_name(number: int) -> str:
+    return f"segment_{number:06d}.ndjson.gz"
+
+
+def _truncate_partial(path: str) -> None:
+    """
+    Обрезает файл до последней завершенной строки:
+    при падении во время записи в конце остается часть строки.
+    :param path: путь к файлу
+    """
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end != len(data):
+            log.info(f"NDJSON drop partial line in {path}")
+            f.truncate(end)
+
+
+class NDJSONSink:
+    """
+    Запись трансформированных пачек в сжатые NDJSON сегменты.
+    Используется вместо Loader: пачка записана, когда bulk вернул управление.
+
+    Каждая пачка - отдельный gzip member в текущем сегменте,
+    сегмент меняется при превышении segment_bytes.
+    В файл index.ndjson для каждой пачки пишется индекс Elasticsearch,
+    сегмент, смещение, длина и количество документов,
+    поэтому пачку можно прочитать без распаковки всего сегмента.
+    Один экземпляр может использоваться несколькими пайплайнами.
+    """
+
+    def __init__(self, path: str, segment_bytes: int):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.segment_number = 0
+        self.segment: Optional[IO[bytes]] = None
+        self.index_file: Optional[IO[str]] = None
+        self._lock = Lock()
+
+    def bulk(self, data: list[dict[str, Any]], index: str) -> list[str]:
+        """
+        Запись пачки в текущий сегмент.
+        :param data: список объектов для загрузки
+        :param index: индекс записи
+        :return: пустой список: конфликтов версий в сегменте нет
+        """
+        lines = "".join(
+            json.dumps(item, default=str) + "\n" for item in data
+        )
+        member = zlib.compressobj(wbits=31)
+        payload = member.compress(lines.encode()) + member.flush()
+        with self._lock:
+            if self.segment.tell() >= self.segment_bytes:
+                self._rotate()
+            offset = self.segment.tell()
+            self.segment.write(payload)
+            self._sync(self.segment)
+            self.index_file.write(json.dumps({
+                "index": index,
+                "segment": _segment_name(self.segment_number),
+                "offset": offset,
+                "length": len(payload),
+                "count": len(data),
+            }) + "\n")
+            self._sync(self.index_file)
+        log.info(f"NDJSON save {index} {len(data)} document")
+        return []
+
+    @staticmethod
+    def _sync(file: IO) -> None:
+        file.flush()
+        os.fsync(file.fileno())
+
+    def _open_segment(self) -> None:
+        self.segment = open(
+            os.path.join(self.path, _segment_name(self.segment_number)), "ab"
+        )
+
+    def _rotate(self) -> None:
+        self.segment.close()
+        self.segment_number += 1
+        self._open_segment()
+
+    def __enter__(self):
+        """
+        Открывает последний сегмент для дозаписи.
+        Незавершенная строка индекса (падение во время записи)
+        отбрасывается, ее пачка будет записана заново.
+        :return: self
+        """
+        os.makedirs(self.path, exist_ok=True)
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_path):
+            _truncate_partial(index_path)
+            with open(index_path) as f:
+                for line in f:
+                    if line.strip():
+                        segment = json.loads(line)["segment"]
+                        self.segment_number = int(segment[8:14])
+        self.index_file = open(index_path, "a")
+        self._open_segment()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Закрывает файлы сегмента и индекса.
+        """
+        self.segment.close()
+        self.index_file.close()
+        log.info("NDJSON sink close")
+
+
+class NDJSONSource:
+    """
+    Чтение пачек, записанных NDJSONSink.
+    Сегменты читаются через mmap, пачка распаковывается
+    по смещению из index.ndjson.
+    Номер последней подтвержденной пачки хранится в стейте
+    каталога отдельно для каждого целевого суффикса индекса.
+    Незавершенная последняя строка индекса
+    (запись еще идет или прервана падением) не читается.
+    """
+
+    def __init__(self, path: str, state: State, index_suffix: str = ""):
+        self.path = path
+        self.index_suffix = index_suffix
+        self.state = state
+        self.checkpoints = CheckpointTracker(state)
+        self.state_key = f"replay{index_suffix}_last_batch"
+
+    def batches(self) -> Iterable[tuple[str, list[dict[str, Any]], int]]:
+        """
+        Функция генератор пачек для загрузки,
+        начиная с пачки после последней подтвержденной.
+        :return: индекс, список объектов для записи, номер пачки
+        """
+        last_batch = self.state.get_state(self.state_key)
+        if last_batch is None:
+            last_batch = -1
+        segment_name, segment_file, segment_map = None, None, None
+        try:
+            with open(os.path.join(self.path, INDEX_FILE)) as index_file:
+                for number, line in enumerate(index_file):
+                    if not line.endswith("\n"):
+                        break
+                    if number <= last_batch:
+                        continue
+                    entry = json.loads(line)
+                    if entry["segment"] != segment_name:
+                        if segment_file is not None:
+                            segment_map.close()
+                            segment_file.close()
+                        segment_name = entry["segment"]
+                        segment_file = open(
+                            os.path.join(self.path, segment_name), "rb"
+                        )
+                        segment_map = mmap.mmap(
+                            segment_file.fileno(), 0, access=mmap.ACCESS_READ
+                        )
+                    offset = entry["offset"]
+                    payload = zlib.decompress(
+                        segment_map[offset:offset + entry["length"]],
+                        wbits=31
+                    )
+                    items = [
+                        json.loads(item) for item in payload.splitlines()
+                    ]
+                    seq = self.checkpoints.begin(self.state_key, number)
+                    yield entry["index"] + self.index_suffix, items, seq
+        finally:
+            if segment_file is not None:
+                segment_map.close()
+                segment_file.close()
@@ -0,0 +1,127 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Iterator
+
+from postgres_to_es.tools.config import ProfileConfig
+
+log = logging.getLogger(__name__)
+
+
+class CycleProfiler:
+    """
+    Профилирование циклов ETL через cProfile и tracemalloc.
+    Профилируются первые config.cycles циклов каждого пайплайна,
+    далее каждый config.every цикл (0 - не профилировать).
+    Одновременно профилируется только один цикл:
+    tracemalloc общий для процесса, поэтому выбранный цикл пайплайна,
+    пришедшийся на время профилирования другого, переносится
+    на следующий цикл этого пайплайна.
+    Отчет пишется в файл <path>/<name>_<cycle>.txt
+    """
+
+    def __init__(self, config: ProfileConfig, path: str):
+        self.config = config
+        self.path = path
+        self._lock = Lock()
+        self._carried: set[str] = set()
+
+    def sampled(self, cycle: int) -> bool:
+        """
+        Нужно ли профилировать цикл.
+        :param cycle: номер цикла, начиная с 1
+        """
+        if not self.config.enabled:
+            return False
+        if cycle <= self.config.cycles:
+            return True
+        return bool(self.config.every) and cycle % self.config.every == 0
+
+    @contextmanager
+    def profile(
+        self, name: str, cycle: int, phases: dict[str, float]
+    ) -> Iterator[None]:
+        """
+        Профилирует выполнение блока и пишет отчет.
+        :param name: имя пайплайна
+        :param cycle: номер цикла
+        :param phases: время фаз цикла, заполняется внутри блока
+        """
+        if not self.sampled(cycle) and name not in self._carried:
+            yield
+            return
+        if not self._lock.acquire(blocking=False):
+            self._carried.add(name)
+            yield
+            return
+        self._carried.discard(name)
+        profiler = cProfile.Profile()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start(self.config.frames)
+        started = perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = perf_counter() - started
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            try:
+                self._write(
+                    name, cycle, elapsed, peak, phases, profiler, snapshot
+                )
+            finally:
+                self._lock.release()
+
+    def _write(
+        self,
+        name: str,
+        cycle: int,
+        elapsed: float,
+        peak: int,
+        phases: dict[str, float],
+        profiler: cProfile.Profile,
+        snapshot: tracemalloc.Snapshot,
+    ) -> None:
+        """
+        Пишет отчет цикла: время фаз, функции по cumulative времени,
+        места выделения памяти.
+        """
+        top = self.config.top
+        stats_stream = io.StringIO()
+        pstats.Stats(profiler, stream=stats_stream).sort_stats(
+            pstats.SortKey.CUMULATIVE
+        ).print_stats(top)
+        snapshot = snapshot.filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        lines = [
+            f"pipeline: {name}",
+            f"cycle: {cycle}",
+            f"wall time: {elapsed:.3f} s",
+            f"peak traced memory: {peak / 1024:.1f} KiB",
+            "",
+            "phases (s):",
+        ]
+        lines += [f"  {phase}: {value:.3f}" for phase, value in phases.items()]
+        lines += ["", f"top {top} allocation sites:"]
+        lines += [
+            f"  {stat}" for stat in snapshot.statistics("lineno")[:top]
+        ]
+        lines += ["", f"top {top} functions by cumulative time:"]
+        lines.append(stats_stream.getvalue())
+        os.makedirs(self.path, exist_ok=True)
+        report = os.path.join(self.path, f"{name}_{cycle:06d}.txt")
+        with open(report, "w") as f:
+            f.write("\n".join(lines))
+        log.info(f"Profile report {report}")
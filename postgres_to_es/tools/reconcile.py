@@ -0,0 +1,114 @@
+import logging
+from typing import Iterable, Iterator, Optional
+
+from postgres_to_es.tools.extractor import PostgresExtractor
+from postgres_to_es.tools.loader import Loader
+
+log = logging.getLogger(__name__)
+
+INDEX = "index"
+DELETE = "delete"
+
+
+def merge_diff(
+    source: Iterator[tuple[str, Optional[int]]],
+    target: Iterator[tuple[str, Optional[int]]],
+    with_version: bool,
+) -> Iterable[tuple[str, str, Optional[int]]]:
+    """
+    Функция генератор сравнения двух отсортированных по uuid потоков.
+    Память не зависит от размера потоков.
+    :param source: uuid и версии документов Postgres
+    :param target: uuid и версии документов Elasticsearch
+    :param with_version: сравнивать версии документов
+    :return: действие (INDEX или DELETE), uuid, версия документа
+    """
+    source_item = next(source, None)
+    target_item = next(target, None)
+    while source_item is not None or target_item is not None:
+        if target_item is None or (
+            source_item is not None and source_item[0] < target_item[0]
+        ):
+            yield INDEX, source_item[0], source_item[1]
+            source_item = next(source, None)
+        elif source_item is None or target_item[0] < source_item[0]:
+            yield DELETE, target_item[0], target_item[1]
+            target_item = next(target, None)
+        else:
+            # версия фильма может уменьшиться (удалена связь),
+            # поэтому устаревшим считается любое расхождение
+            if with_version and source_item[1] is not None and (
+                source_item[1] != target_item[1]
+            ):
+                yield INDEX, source_item[0], source_item[1]
+            source_item = next(source, None)
+            target_item = next(target, None)
+
+
+class Reconciler:
+    """
+    Сверка индекса пайплайна с таблицей Postgres.
+    Документы, которых нет в Postgres, удаляются из индекса,
+    отсутствующие и устаревшие документы загружаются заново
+    с версией не ниже версии индекса.
+    """
+
+    def __init__(
+        self,
+        extractor: PostgresExtractor,
+        loader: Loader,
+        with_version: bool = True,
+    ):
+        self.extractor = extractor
+        self.loader = loader
+        self.pipeline = extractor.pipeline
+        self.batch_size = extractor.batch_size
+        self.with_version = with_version and self.pipeline.versioned
+
+    def run(self) -> dict[str, int]:
+        """
+        Выполняет сверку.
+        Point in time индекса открывается раньше выборки из Postgres,
+        поэтому документ, созданный во время сверки, не будет удален.
+        :return: количество удаленных и загруженных документов
+        """
+        index = self.pipeline.index
+        pit_id = self.loader.open_point_in_time(index)
+        target = iter(self.loader.iter_ids(pit_id, self.batch_size))
+        source = iter(self.extractor.reconcile_ids(self.with_version))
+        counts = {DELETE: 0, INDEX: 0}
+        deletes: list[tuple[str, Optional[int]]] = []
+        reindex: list[str] = []
+        log.info(f"Start reconcile {self.pipeline.name}")
+        for action, doc_id, version in merge_diff(
+                source, target, self.with_version
+        ):
+            if action == DELETE:
+                deletes.append((doc_id, version))
+                if len(deletes) >= self.batch_size:
+                    counts[DELETE] += self._delete(deletes)
+                    deletes = []
+            else:
+                reindex.append(doc_id)
+                if len(reindex) >= self.batch_size:
+                    counts[INDEX] += self._reindex(reindex)
+                    reindex = []
+        counts[DELETE] += self._delete(deletes)
+        counts[INDEX] += self._reindex(reindex)
+        log.info(
+            f"End reconcile {self.pipeline.name}: "
+            f"delete {counts[DELETE]}, index {counts[INDEX]}"
+        )
+        return counts
+
+    def _delete(self, deletes: list[tuple[str, Optional[int]]]) -> int:
+        if deletes:
+            self.loader.delete(deletes, self.pipeline.index)
+        return len(deletes)
+
+    def _reindex(self, reindex: list[str]) -> int:
+        if reindex:
+            items = self.extractor.documents_in(reindex)
+            if items:
+                self.loader.overwrite(items, self.pipeline.index)
+        return len(reindex)
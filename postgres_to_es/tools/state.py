@@ -1,6 +1,8 @@
 import abc
 import json
+import os
 from json import JSONDecodeError
+from threading import RLock
 from typing import Any, Dict
 
 
@@ -26,26 +28,33 @@ class JsonFileStorage(BaseStorage):
     """Реализация хранилища, использующего локальный файл.
 
     Формат хранения: JSON
+    Один экземпляр может использоваться несколькими потоками,
+    файл перезаписывается атомарно.
     """
 
     def __init__(self, file_path: str) -> None:
         self.file_path = file_path
+        self._lock = RLock()
 
     def save_state(self, state: Dict[str, Any]) -> None:
         """Сохранить состояние в хранилище."""
-        last_state = self.retrieve_state()
-        with open(self.file_path, "w+") as f:
+        with self._lock:
+            last_state = self.retrieve_state()
             for key, value in state.items():
                 last_state[key] = value
-            f.write(json.dumps(last_state))
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, "w+") as f:
+                f.write(json.dumps(last_state))
+            os.replace(tmp_path, self.file_path)
 
     def retrieve_state(self) -> Dict[str, Any]:
         """Получить состояние из хранилища."""
-        try:
-            with open(self.file_path) as f:
-                return json.load(f)
-        except (FileNotFoundError, JSONDecodeError):
-            return {}
+        with self._lock:
+            try:
+                with open(self.file_path) as f:
+                    return json.load(f)
+            except (FileNotFoundError, JSONDecodeError):
+                return {}
 
 
 class State:
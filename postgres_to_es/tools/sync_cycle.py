@@ -0,0 +1,85 @@
+import logging
+from datetime import datetime
+from threading import Barrier, Lock
+from typing import Any
+
+from postgres_to_es.tools.state import State
+
+log = logging.getLogger(__name__)
+
+START_TIME_KEY = "cycle_start_time"
+
+
+class SyncCycle:
+    """
+    Общий цикл пайплайнов, работающих в отдельных потоках.
+    Все пайплайны цикла используют одну дату старта -
+    минимум предложенных пайплайнами дат.
+    Состояния окончания цикла пайплайнов не записываются сразу,
+    а собираются и сохраняются одной записью, когда цикл
+    закончили все пайплайны. Время цикла - максимум времени
+    пайплайнов, а не их сумма.
+    """
+
+    def __init__(self, state: State, parties: int):
+        self.state = state
+        self.pending: dict[str, Any] = {}
+        self.barrier = Barrier(parties, action=self._commit)
+        self.start_barrier = Barrier(parties, action=self._start)
+        self.candidates: list[datetime] = []
+        self._lock = Lock()
+
+    def start_time(self, candidate: datetime) -> str:
+        """
+        Дата старта текущего цикла.
+        Каждый пайплайн предлагает свою дату (время, до которого
+        его источник применил изменения) и ждет остальные.
+        Дата старта - минимум предложенных, так ни один пайплайн
+        не выберет изменения, которых еще нет в его источнике.
+        Дата сохраняется в стейт, при перезапуске незаконченный цикл
+        продолжается с той же датой.
+        Ошибка BrokenBarrierError, если один из пайплайнов остановился.
+        :param candidate: дата, предложенная пайплайном
+        :return: дата старта
+        """
+        with self._lock:
+            self.candidates.append(candidate)
+        self.start_barrier.wait()
+        return self.state.get_state(START_TIME_KEY)
+
+    def defer(self, batch_state: dict[str, Any]) -> None:
+        """
+        Откладывает состояния окончания цикла пайплайна.
+        :param batch_state: состояния окончания цикла
+        """
+        with self._lock:
+            self.pending.update(batch_state)
+
+    def wait(self) -> None:
+        """
+        Ожидает окончания цикла всеми пайплайнами.
+        Ошибка BrokenBarrierError, если один из пайплайнов остановился.
+        """
+        self.barrier.wait()
+
+    def abort(self) -> None:
+        """
+        Прерывает ожидание остальных пайплайнов.
+        """
+        self.barrier.abort()
+        self.start_barrier.abort()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self.state.get_state(START_TIME_KEY) is None:
+                self.state.set_state(
+                    START_TIME_KEY, str(min(self.candidates))
+                )
+            self.candidates = []
+
+    def _commit(self) -> None:
+        with self._lock:
+            self.pending[START_TIME_KEY] = None
+            self.state.butch_set_state(self.pending)
+            self.pending = {}
+        log.info("Set Last_modified for all pipelines")
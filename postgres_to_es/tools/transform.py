@@ -1,54 +1,52 @@
-from typing import Any
+from typing import Any, Callable, Optional, Sequence
 
 from psycopg2.extras import DictRow
 
+from postgres_to_es.tools import models
 from postgres_to_es.tools.models import (
     FilmWorkES,
-    GenresES,
+    Genre,
     Person,
-    PersonES,
     PersonType,
-    Genre,
 )
 
 
 class Transform:
-    def __init__(self, movie: DictRow, index: str):
-        self.raw_data = movie
-        self.index = index
+    def __init__(self, raw_data: DictRow, model: Optional[str]):
+        self.raw_data = raw_data
+        self.model = model
 
-    def transform(self) -> dict[str, Any] | None:
+    def transform(self) -> dict[str, Any]:
         """
         Функция трансформации формата данных
         для загрузки в Elasticsearch.
+        Модель фильма требует сборки персон и жанров,
+        остальные модели валидируются по полям строки.
+        Без модели строка загружается как есть.
+        Колонка version строки становится внешней версией документа.
         :return: данные в виде словаря
         """
-        match self.index:
-            case "movies":
-                return self._add_elastic_id(
-                    self._pre_validate_movie(self.raw_data)
-                )
-            case "persons":
-                return self._add_elastic_id(
-                    self._pre_validate_person(self.raw_data)
-                )
-            case "genres":
-                return self._add_elastic_id(
-                    self._pre_validate_genre(self.raw_data)
-                )
+        match self.model:
+            case "FilmWorkES":
+                document = self._pre_validate_movie(self.raw_data)
+            case None:
+                document = dict(self.raw_data)
+                document.pop("version", None)
+            case _:
+                document = self._pre_validate(self.raw_data, self.model)
+        return self._add_version(
+            self.raw_data, self._add_elastic_id(document)
+        )
 
     @staticmethod
-    def _pre_validate_person(raw_data: DictRow) -> dict[str, Any]:
+    def _pre_validate(raw_data: DictRow, model: str) -> dict[str, Any]:
         """
-        Функция валидирует данные через модель PersonES
-        и возвращает данные фильма в виде словаря.
+        Функция валидирует данные через модель из models
+        и возвращает данные в виде словаря.
         для загрузки в Elasticsearch.
         :return: данные в виде словаря
         """
-        return PersonES(
-            id=raw_data["id"],
-            full_name=raw_data["full_name"]
-        ).dict()
+        return getattr(models, model).parse_obj(dict(raw_data)).dict()
 
     @staticmethod
     def _add_elastic_id(valid_data: dict[str, Any]):
@@ -60,18 +58,21 @@ class Transform:
         return valid_data
 
     @staticmethod
-    def _pre_validate_genre(raw_data: DictRow) -> dict[str, Any]:
+    def _add_version(raw_data: DictRow, valid_data: dict[str, Any]):
         """
-        Функция валидирует данные через модель GenresES
-        и возвращает данные фильма в виде словаря.
-        для загрузки в Elasticsearch.
+        Функция добавляет внешнюю версию документа
+        из колонки version, если она есть в строке.
+        Более старая версия не перезапишет документ в Elasticsearch.
         :return: данные в виде словаря
         """
-        return GenresES(
-            id=raw_data["id"],
-            name=raw_data["name"],
-            description=raw_data["description"],
-        ).dict()
+        try:
+            version = raw_data["version"]
+        except KeyError:
+            return valid_data
+        if version is not None:
+            valid_data["_version"] = int(version)
+            valid_data["_version_type"] = "external"
+        return valid_data
 
     @staticmethod
     def _pre_validate_movie(raw_data: DictRow) -> dict[str, Any]:
@@ -132,3 +133,86 @@ class Transform:
             actors=actors,
             writers=writers,
         ).dict()
+
+
+class CompactTransform:
+    """
+    Трансформация строк обычного курсора (кортежей) без DictRow
+    и промежуточных моделей pydantic.
+    Позиции колонок вычисляются один раз по описанию курсора,
+    документ собирается напрямую из кортежа.
+    Проверку схемы выполняет маппинг индекса ("dynamic": "strict").
+    """
+
+    __slots__ = ("positions", "fields", "version", "build")
+
+    def __init__(self, model: Optional[str], description: Sequence):
+        self.positions = {
+            column[0]: position for position, column in enumerate(description)
+        }
+        self.version = self.positions.get("version")
+        if model is None:
+            self.fields = tuple(
+                item for item in self.positions.items() if item[0] != "version"
+            )
+        else:
+            self.fields = tuple(
+                (field, self.positions[field])
+                for field in getattr(models, model).__fields__
+                if field in self.positions
+            )
+        self.build: Callable[[tuple], dict[str, Any]] = (
+            self._movie if model == "FilmWorkES" else self._document
+        )
+
+    def __call__(self, row: tuple) -> dict[str, Any]:
+        """
+        Функция трансформации строки для загрузки в Elasticsearch.
+        :param row: строка курсора
+        :return: данные в виде словаря
+        """
+        document = self.build(row)
+        document["_id"] = document["id"]
+        if self.version is not None and row[self.version] is not None:
+            document["_version"] = int(row[self.version])
+            document["_version_type"] = "external"
+        return document
+
+    def _document(self, row: tuple) -> dict[str, Any]:
+        return {field: row[position] for field, position in self.fields}
+
+    def _movie(self, row: tuple) -> dict[str, Any]:
+        positions = self.positions
+        roles: dict[str, tuple[list, list]] = {
+            PersonType.actor.value: ([], []),
+            PersonType.writer.value: ([], []),
+            PersonType.director.value: ([], []),
+        }
+        for person in row[positions["persons"]]:
+            role = roles.get(person["person_role"])
+            if role is not None:
+                role[0].append(
+                    {"id": person["person_id"], "name": person["person_name"]}
+                )
+                role[1].append(person["person_name"])
+        genres = [
+            {"id": genre["genre_id"], "name": genre["genre_name"]}
+            for genre in row[positions["genres"]]
+        ]
+        actors, actors_name = roles[PersonType.actor.value]
+        writers, writers_name = roles[PersonType.writer.value]
+        directors, directors_name = roles[PersonType.director.value]
+        return {
+            "id": row[positions["id"]],
+            "title": row[positions["title"]],
+            "imdb_rating": row[positions["rating"]],
+            "genres": genres,
+            "genres_name": [genre["name"] for genre in genres],
+            "description": row[positions["description"]],
+            "directors_name": directors_name,
+            "actors_names": actors_name,
+            "writers_names": writers_name,
+            "actors": actors,
+            "directors": directors,
+            "writers": writers,
+        }